@@ -0,0 +1,164 @@
+"""Асинхронный журнал сервера с уровнями и сэмплированием
+
+Вызывающий поток только кладет запись (время, уровень, событие, поля) в ограниченную
+очередь; форматирование и запись в поток вывода делает фоновый поток. Очередь
+переполнена - запись выбрасывается и считается в dropped, сервер не ждет stdout.
+
+Горячий путь проверяет уровень сам, до вызова и до сборки полей:
+
+    if log.level <= INFO:
+        log.access(client, req, resp)
+
+Записи access - по одной на запрос, из них пишется каждая sample-я.
+Настройка из окружения: ACCESS_LOG_LEVEL (debug, info, warning, error, off) и ACCESS_LOG_SAMPLE.
+"""
+import atexit
+import collections
+import json
+import os
+import sys
+import threading
+import time
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+OFF = 100
+
+LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR, 'off': OFF}
+LEVEL_NAMES = {level: name.upper() for name, level in LEVELS.items()}
+
+# сколько записей ждут фонового потока, прежде чем новые начнут выбрасываться
+MAX_QUEUE = 10_000
+# фоновый поток просыпается не чаще раза в FLUSH_INTERVAL секунд и пишет все накопленное
+FLUSH_INTERVAL = 0.05
+
+
+class AccessLog:
+    def __init__(self, level=INFO, sample=1, stream=None, max_queue=MAX_QUEUE):
+        """sample - писать каждую sample-ю запись access; stream - по умолчанию sys.stdout"""
+        self.level = level
+        self.sample = sample
+        self.stream = stream
+        self.max_queue = max_queue
+        self.dropped = 0
+        self._seen = 0
+        # deque.append/popleft атомарны: записывающие потоки обходятся без блокировок
+        self._records = collections.deque()
+        self._wakeup = threading.Event()
+        self._thread = None
+        # первую запись могут сделать сразу несколько потоков ThreadingTCPServer:
+        # писатель должен подняться один, иначе close дождется только последнего
+        self._start_lock = threading.Lock()
+        self._closing = False
+        # поток не переживает fork: в дочернем процессе поднимем свой при первой записи
+        os.register_at_fork(after_in_child=self._reset)
+        atexit.register(self.close)
+
+    def debug(self, event, **fields):
+        if self.level <= DEBUG:
+            self._put(DEBUG, event, fields)
+
+    def info(self, event, **fields):
+        if self.level <= INFO:
+            self._put(INFO, event, fields)
+
+    def warning(self, event, **fields):
+        if self.level <= WARNING:
+            self._put(WARNING, event, fields)
+
+    def error(self, event, **fields):
+        if self.level <= ERROR:
+            self._put(ERROR, event, fields)
+
+    def access(self, client, req, resp):
+        """Запись об обслуженном запросе; тело ответа - только на уровне DEBUG"""
+        self._seen += 1
+        if self._seen % self.sample:
+            return
+        if self.level <= DEBUG:
+            self._put(DEBUG, 'access', {'client': client, 'req': req, 'resp': resp})
+        else:
+            self._put(INFO, 'access', {'client': client, 'req': req, 'bytes': len(resp)})
+
+    def _put(self, level, event, fields):
+        if self._thread is None:
+            self._start()
+        if len(self._records) >= self.max_queue:
+            self.dropped += 1
+            return
+        self._records.append((time.time(), level, event, fields))
+        if not self._wakeup.is_set():
+            self._wakeup.set()
+
+    def _start(self):
+        with self._start_lock:
+            if self._thread is None:
+                thread = threading.Thread(target=self._writer, name='access-log', daemon=True)
+                thread.start()
+                self._thread = thread
+
+    def _writer(self):
+        records = self._records
+        while True:
+            self._wakeup.wait()
+            if not self._closing:
+                # копим пачку: меньше переключений GIL и системных вызовов write
+                time.sleep(FLUSH_INTERVAL)
+            # сбрасываем до разбора: запись, пришедшая после, снова взведет событие
+            self._wakeup.clear()
+            lines = []
+            while records:
+                lines.append(format_record(records.popleft()))
+            if lines:
+                stream = self.stream or sys.stdout
+                stream.write(''.join(lines))
+                stream.flush()
+            # флаг читаем после разбора: close мог прийти, пока спали
+            if self._closing and not records:
+                return
+
+    def close(self):
+        """Дописывает очередь; после fork без exec вызывать перед os._exit"""
+        if self._thread is None:
+            return
+        self._closing = True
+        self._wakeup.set()
+        self._thread.join()
+        self._thread = None
+        self._closing = False
+
+    def _reset(self):
+        self._thread = None
+        # в момент fork блокировку мог держать другой поток родителя
+        self._start_lock = threading.Lock()
+        self._closing = False
+        self._records = collections.deque()
+        self._wakeup = threading.Event()
+
+
+def format_record(record):
+    """logfmt: время уровень событие ключ=значение..."""
+    ts, level, event, fields = record
+    line = f'{ts:.3f} {LEVEL_NAMES[level]} {event}'
+    for key, value in fields.items():
+        line += f' {key}={format_value(value)}'
+    return line + '\n'
+
+
+def format_value(value):
+    if isinstance(value, (bytes, bytearray)):
+        value = value.decode('utf-8', 'backslashreplace')
+    elif isinstance(value, tuple):
+        value = ':'.join(map(str, value))
+    value = str(value)
+    if not value or not value.isprintable() or ' ' in value or '"' in value or '=' in value:
+        return json.dumps(value, ensure_ascii=False)
+    return value
+
+
+log = AccessLog(
+    level=LEVELS[os.environ.get('ACCESS_LOG_LEVEL', 'info').lower()],
+    sample=int(os.environ.get('ACCESS_LOG_SAMPLE', 1)),
+)
@@ -0,0 +1,49 @@
+"""Бенчмарк кеша ответов: GET горячих ключей с кешем и без
+
+Гоняем RequestHandler.handle_request в процессе, без сокетов и с выключенным журналом:
+разбор запроса, поиск сущностей и сборка кадра ответа.
+
+usage: python bench_cache.py [seconds]
+"""
+import sys
+import time
+
+from access_log import OFF, log
+from cache import LRUCache
+from server import RESPONSE_CACHE_SIZE, RequestHandler
+
+HOT_KEYS = 100
+
+
+def bench(name, requests, cache_size, seconds):
+    handler = RequestHandler()
+    handler.client_address = ('127.0.0.1', 0)
+    log.level = OFF
+    RequestHandler.cache = LRUCache(cache_size)
+    for req in requests:
+        handler.handle_request(req)
+
+    done = 0
+    deadline = time.perf_counter() + seconds
+    start = time.perf_counter()
+    while time.perf_counter() < deadline:
+        for req in requests:
+            handler.handle_request(req)
+        done += len(requests)
+    elapsed = time.perf_counter() - start
+    mode = 'cache' if cache_size else 'no cache'
+    print(f'{name:>14} {mode:>8}: {done / elapsed:10.0f} req/s')
+
+
+def main(seconds):
+    single = [f'GET user {i}'.encode('ascii') for i in range(HOT_KEYS)]
+    accounts = [f'GET account {i + 1}'.encode('ascii') for i in range(HOT_KEYS)]
+    multi = [('GET user ' + ','.join(map(str, range(HOT_KEYS)))).encode('ascii')]
+    # счета 1..HOT_KEYS появляются вместе с пользователями, GET user идет первым
+    for name, requests in (('GET user', single), ('GET account', accounts), ('GET user x100', multi)):
+        for cache_size in (0, RESPONSE_CACHE_SIZE):
+            bench(name, requests, cache_size, seconds)
+
+
+if __name__ == '__main__':
+    main(float(sys.argv[1]) if len(sys.argv) > 1 else 2)
@@ -0,0 +1,81 @@
+"""Бенчмарк диспетчеризации: callbacks в секунду при N постоянно готовых сокетах
+
+pop   - прежняя модель: один callback на вызов Queue.pop, hrtime() на итерацию
+        и еще дважды вокруг каждого callback в _execute
+batch - EventLoop._run_once: один poll, затем прогон снимка очереди
+
+usage: python bench_dispatch.py [seconds]
+"""
+import resource
+import selectors
+import socket
+import sys
+import time
+
+from event_loop import EventLoop, hrtime
+
+
+def readable_sockets(n):
+    """n сокетов, которые всегда готовы к чтению: в буфере данные и EOF"""
+    socks = []
+    for _ in range(n):
+        a, b = socket.socketpair()
+        a.setblocking(False)
+        b.sendall(b'x')
+        b.close()
+        socks.append(a)
+    return socks
+
+
+def pop_iteration(loop):
+    queue = loop._queue
+    loop._time = hrtime()
+    fn, args = (queue._ready or queue.poll(loop._time)).popleft()
+    loop._time = hrtime()
+    loop._execute(fn, *args)
+    loop._time = hrtime()
+
+
+def batch_iteration(loop):
+    loop._run_once()
+
+
+def bench(socks, iteration, seconds):
+    loop = EventLoop()
+    calls = 0
+
+    def on_event(mask):
+        nonlocal calls
+        calls += 1
+
+    for sock in socks:
+        loop._queue.register_fileobj(sock, on_event, selectors.EVENT_READ)
+
+    deadline = time.monotonic() + seconds
+    start = time.perf_counter()
+    while time.monotonic() < deadline:
+        for _ in range(100):
+            iteration(loop)
+    elapsed = time.perf_counter() - start
+
+    for sock in socks:
+        loop._queue.unregister_fileobj(sock)
+    loop._queue.close()
+    return calls / elapsed
+
+
+def main(seconds):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    for n in (1, 100, 10_000):
+        socks = readable_sockets(n)
+        pop = bench(socks, pop_iteration, seconds)
+        batch = bench(socks, batch_iteration, seconds)
+        print(f'{n:>6} ready sockets: pop {pop:12.0f} cb/s  batch {batch:12.0f} cb/s  x{batch / pop:.2f}')
+        for sock in socks:
+            sock.close()
+
+
+if __name__ == '__main__':
+    main(float(sys.argv[1]) if len(sys.argv) > 1 else 2)
@@ -0,0 +1,116 @@
+"""Бенчмарк EventLoop.run_in_executor
+
+lag: пульс - таймер каждую миллисекунду, пока цикл выполняет JOBS блокирующих вызовов
+(time.sleep(BLOCK), как DNS или чтение с диска, отпускают GIL) прямо в callback'ах против
+run_in_executor. Задержка пульса - сколько цикл не мог обслужить остальных.
+
+roundtrip: пустая задача в пул и результат обратно в цикл - по одной (задержка) и пачками
+по BURST (пропускная способность и пробуждений цикла на результат), waker на eventfd
+против self-pipe.
+
+usage: python bench_executor.py [jobs]
+"""
+import functools
+import sys
+import time
+
+import event_loop
+from consts import MS
+from event_loop import Context, EventLoop, from_callback, gather, set_timer
+
+BLOCK = 0.002
+BURST = 1000
+ROUNDTRIPS = 5000
+
+
+def heartbeat(lags, stop):
+    expected = time.monotonic() + 0.001
+
+    def beat():
+        nonlocal expected
+        now = time.monotonic()
+        lags.append(max(now - expected, 0))
+        if not stop():
+            expected = now + 0.001
+            set_timer(MS, beat)
+
+    set_timer(MS, beat)
+
+
+def bench_lag(mode, jobs):
+    loop = EventLoop()
+    Context.set_event_loop(loop)
+    lags = []
+    done = 0
+
+    async def main():
+        nonlocal done
+        heartbeat(lags, lambda: done == jobs)
+        if mode == 'inline':
+            for _ in range(jobs):
+                # так выглядит блокирующий вызов в callback'е: цикл стоит
+                await from_callback(lambda callback: callback(None, time.sleep(BLOCK)))
+                done += 1
+        else:
+            async def job():
+                nonlocal done
+                await from_callback(loop.run_in_executor, time.sleep, BLOCK)
+                done += 1
+            await gather(*(job() for _ in range(jobs)))
+
+    started = time.perf_counter()
+    loop.run(main)
+    elapsed = time.perf_counter() - started
+    lags.sort()
+    print(
+        f'lag {mode:>8}: {jobs} x {BLOCK * 1e3:.0f} ms in {elapsed:6.3f} s  {len(lags):4} heartbeats,'
+        f' lag p50 {lags[len(lags) // 2] * 1e3:7.2f} ms  max {lags[-1] * 1e3:7.2f} ms'
+    )
+
+
+class CountingWaker(event_loop._Waker):
+    """clear зовется раз на пробуждение цикла"""
+    wakeups = 0
+
+    def clear(self):
+        CountingWaker.wakeups += 1
+        super().clear()
+
+
+def bench_roundtrip(waker):
+    event_loop._Waker = functools.partial(CountingWaker, use_eventfd=waker == 'eventfd')
+    loop = EventLoop()
+    Context.set_event_loop(loop)
+
+    async def main():
+        # прогрев: потоки пула и waker создаются при первом вызове
+        await from_callback(loop.run_in_executor, int)
+
+        started = time.perf_counter()
+        for _ in range(ROUNDTRIPS):
+            await from_callback(loop.run_in_executor, int)
+        latency = (time.perf_counter() - started) / ROUNDTRIPS
+
+        CountingWaker.wakeups = 0
+        started = time.perf_counter()
+        for _ in range(ROUNDTRIPS // BURST * 10):
+            await gather(*(from_callback(loop.run_in_executor, int) for _ in range(BURST)))
+        results = ROUNDTRIPS * 10
+        elapsed = time.perf_counter() - started
+        print(
+            f'roundtrip {waker:>7}: latency {latency * 1e6:6.1f} us  burst {results / elapsed:8.0f} results/s'
+            f'  {CountingWaker.wakeups / results:5.3f} wakeups per result'
+        )
+
+    loop.run(main)
+
+
+def main(jobs):
+    for mode in ('inline', 'executor'):
+        bench_lag(mode, jobs)
+    for waker in ('eventfd', 'pipe'):
+        bench_roundtrip(waker)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
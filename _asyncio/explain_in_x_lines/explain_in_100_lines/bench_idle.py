@@ -0,0 +1,104 @@
+"""Бенчмарк: N простаивающих TCP соединений в одном Queue
+
+legacy - каждый сокет подписан на EVENT_READ | EVENT_WRITE (как было раньше)
+masks  - подписка следует за ожидающими callbacks: у каждого сокета висит только recv
+
+Считаем пробуждения селектора в секунду, вызовы callbacks и CPU время процесса.
+
+usage: python bench_idle.py [connections] [seconds]
+"""
+import os
+import resource
+import selectors
+import socket
+import sys
+import time
+
+from event_loop import Queue
+
+
+def raise_nofile_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def open_connections(n):
+    """Поднимает n соединений; серверные концы держит дочерний процесс,
+    чтобы не упереться в лимит дескрипторов"""
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(min(n, socket.SOMAXCONN))
+    stop_r, stop_w = os.pipe()
+
+    pid = os.fork()
+    if pid == 0:
+        os.close(stop_w)
+        accepted = [listener.accept()[0] for _ in range(n)]
+        os.read(stop_r, 1)  # ждем, пока родитель закроет pipe
+        os._exit(0)
+
+    os.close(stop_r)
+    socks = []
+    for _ in range(n):
+        sock = socket.create_connection(listener.getsockname())
+        sock.setblocking(False)
+        socks.append(sock)
+    listener.close()
+    return socks, pid, stop_w
+
+
+def run(queue, seconds):
+    calls = 0
+
+    wakeups = 0
+    cpu = time.process_time()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        events = queue.select(0.1)
+        if events:
+            wakeups += 1
+        for callback, mask in events:
+            callback(mask)
+            calls += 1
+    cpu = time.process_time() - cpu
+    return wakeups / seconds, calls / seconds, cpu
+
+
+def bench(socks, mode, seconds):
+    queue = Queue()
+
+    def on_event(mask):
+        pass
+
+    for sock in socks:
+        if mode == 'legacy':
+            queue.register_fileobj(sock, on_event, selectors.EVENT_READ | selectors.EVENT_WRITE)
+        else:
+            queue.register_fileobj(sock, on_event, selectors.EVENT_READ)
+
+    wakeups, calls, cpu = run(queue, seconds)
+    print(f'{mode:>6}: {wakeups:10.1f} wakeups/s {calls:12.1f} callbacks/s cpu {cpu:.3f}s / {seconds}s')
+
+    for sock in socks:
+        queue.unregister_fileobj(sock)
+    queue.close()
+
+
+def main(n, seconds):
+    raise_nofile_limit()
+    socks, pid, stop_w = open_connections(n)
+    print(f'{n} idle connections')
+    try:
+        for mode in ('legacy', 'masks'):
+            bench(socks, mode, seconds)
+    finally:
+        for sock in socks:
+            sock.close()
+        os.close(stop_w)
+        os.waitpid(pid, 0)
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 3
+    main(n, seconds)
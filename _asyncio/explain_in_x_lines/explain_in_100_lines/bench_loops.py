@@ -0,0 +1,148 @@
+"""Масштабирование по числу EventLoop: сценарий get_user_balance (get_user, затем get_balance
+его счета) без случайных задержек, FLOWS сценариев в полете в замкнутом цикле
+
+threads: LoopGroup из n циклов в потоках, у каждого свой Client; каждый сценарий раздается
+заново по policy (round-robin, least-loaded). Сервер - python server.py <port> loops n.
+processes: n процессов, в каждом EventLoop, Client и FLOWS / n сценариев. Сервер -
+python server.py <port> prefork n.
+
+Сервер в отдельном процессе, меряем сценарии в секунду на стороне клиента и доли
+сценариев по циклам.
+
+usage: python bench_loops.py [seconds] [max_loops]
+"""
+import itertools
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from access_log import OFF, log
+from benchlib import start_server
+from client import Client
+from event_loop import Context, EventLoop
+from multiloop import POLICIES, LoopGroup
+
+FLOWS = 64
+
+
+def user_balance(client, user_id, callback):
+    def on_user(error, user=None):
+        if error:
+            return callback(error)
+        client.get_balance(user['account_id'], callback)
+
+    client.get_user(user_id, on_user)
+
+
+def bench_threads(port, loops, policy, seconds):
+    group = LoopGroup(
+        loops, policy,
+        setup=lambda: Client(('127.0.0.1', port), max_connections=FLOWS),
+        teardown=Client.close,
+    )
+    group.start()
+    # next() у count атомарен - считаем из потоков всех циклов без блокировки
+    flows = itertools.count()
+    in_flight = FLOWS
+    lock = threading.Lock()
+    finished = threading.Event()
+    deadline = time.monotonic() + seconds
+
+    def on_balance(user_id, error, account=None):
+        nonlocal in_flight
+        if error:
+            raise error
+        next(flows)
+        if time.monotonic() < deadline:
+            return start(user_id)
+        # каждый цикл завершает свои сценарии сам, счетчик общий
+        with lock:
+            in_flight -= 1
+            if not in_flight:
+                finished.set()
+
+    def start(user_id):
+        group.dispatch(user_balance, user_id, lambda *result: on_balance(user_id, *result))
+
+    for user_id in range(FLOWS):
+        start(user_id)
+    finished.wait()
+    group.stop()
+    total = next(flows)
+    completed = [worker.completed for worker in group.workers]
+    shares = '/'.join(f'{n * 100 // max(sum(completed), 1)}' for n in completed)
+    print(f'threads   {loops} loops {policy:>12}: {total / seconds:8.0f} flows/s  share % {shares}')
+
+
+def child_process(port, flows, seconds):
+    loop = EventLoop()
+    Context.set_event_loop(loop)
+    client = Client(('127.0.0.1', port), max_connections=flows)
+    done = 0
+    deadline = time.monotonic() + seconds
+
+    def start(user_id):
+        def on_balance(error, account=None):
+            nonlocal done
+            if error:
+                raise error
+            done += 1
+            if time.monotonic() < deadline:
+                start(user_id)
+
+        user_balance(client, user_id, on_balance)
+
+    def main():
+        for user_id in range(flows):
+            start(user_id)
+
+    loop.run(main)
+    client.close()
+    print(done)
+
+
+def bench_processes(port, loops, seconds):
+    children = [
+        subprocess.Popen(
+            [sys.executable, __file__, '--child', str(port), str(FLOWS // loops), str(seconds)],
+            stdout=subprocess.PIPE, text=True,
+        )
+        for _ in range(loops)
+    ]
+    done = [int(child.communicate()[0]) for child in children]
+    shares = '/'.join(f'{n * 100 // max(sum(done), 1)}' for n in done)
+    print(f'processes {loops} loops {"":>12}: {sum(done) / seconds:8.0f} flows/s  share % {shares}')
+
+
+def main(seconds, max_loops):
+    counts = [n for n in (1, 2, 4, 8) if n <= max_loops]
+    for loops in counts:
+        server, port = start_server('loops', str(loops))
+        try:
+            for policy in POLICIES:
+                bench_threads(port, loops, policy, seconds)
+        finally:
+            server.terminate()
+            server.wait()
+    for loops in counts:
+        server, port = start_server('prefork', str(loops))
+        try:
+            bench_processes(port, loops, seconds)
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == '__main__':
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    log.level = OFF
+    if sys.argv[1:2] == ['--child']:
+        child_process(int(sys.argv[2]), int(sys.argv[3]), float(sys.argv[4]))
+    else:
+        print(f'{os.cpu_count()} cpu')
+        main(
+            float(sys.argv[1]) if len(sys.argv) > 1 else 5,
+            int(sys.argv[2]) if len(sys.argv) > 2 else max(os.cpu_count(), 4),
+        )
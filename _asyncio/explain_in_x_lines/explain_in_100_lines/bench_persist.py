@@ -0,0 +1,157 @@
+"""Бенчмарк persist.py: время старта и пропускная способность записи
+
+load: n пользователей и n счетов пишутся снимком, затем в отдельном процессе меряется
+загрузка снимка через mmap и проигрывание журнала из COMPACT_RECORDS записей - больше
+журнал не вырастает, так что это худший случай старта.
+
+write: writers конкурентных писателей в EventLoop, каждый в замкнутом цикле меняет баланс
+и ждет commit_later; group commit против fsync на каждую запись. threads - то же потоками
+через синхронный commit, как в потоковом Handler.
+
+usage: python bench_persist.py [entities] [seconds] [writers] [dir]
+"""
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from event_loop import set_timer, Context, EventLoop
+from persist import COMPACT_RECORDS, GROUP_COMMIT_INTERVAL, OP_ACCOUNT, OP_USER, Storage
+from consts import SEC
+from store import AccountStore, UserStore
+
+
+def build(path, n):
+    users, accounts = UserStore(), AccountStore()
+    storage = Storage(path, users, accounts, threading.Lock(), compact_records=0)
+    storage.load()
+    for i in range(n):
+        accounts.add(i + 1, random.randint(0, 100))
+        users.add(i, f'{random.getrandbits(32):08x}', i + 1)
+
+    started = time.perf_counter()
+    storage.compact()
+    print(f'snapshot {n:>10}: write {time.perf_counter() - started:7.2f} s'
+          f'  {os.path.getsize(os.path.join(path, "snapshot")) / 2 ** 20:8.1f} MB')
+
+    # журнал к следующему старту: изменения балансов, как от set_balance
+    for i in range(COMPACT_RECORDS):
+        storage.append(OP_ACCOUNT, random.randrange(n) + 1, i)
+    storage.wal.close()
+
+
+def child_load(path):
+    users, accounts = UserStore(), AccountStore()
+    storage = Storage(path, users, accounts, threading.Lock())
+    started = time.perf_counter()
+    replayed = storage.load()
+    elapsed = time.perf_counter() - started
+    storage.wal.close()
+    print(f'startup  {len(users):>10}: {elapsed:7.2f} s  (replayed {replayed} wal records)')
+
+
+def bench_load(path, n):
+    build(path, n)
+    # отдельный процесс: загрузка в чистую память, без страниц, оставшихся от build
+    subprocess.run([sys.executable, __file__, '--load', path])
+    for name in os.listdir(path):
+        os.remove(os.path.join(path, name))
+
+
+def bench_loop(path, seconds, writers, group_commit):
+    loop = EventLoop()
+    Context.set_event_loop(loop)
+    storage = Storage(path, UserStore(), AccountStore(), threading.Lock(), group_commit=group_commit)
+    storage.load()
+    done = 0
+    stopped = False
+
+    def writer(account_id):
+        def write():
+            nonlocal done
+            if stopped:
+                return
+            done += 1
+            storage.append(OP_ACCOUNT, account_id, done)
+            storage.commit_later(on_commit)
+
+        def on_commit(error):
+            if error:
+                raise error
+            # без группировки commit_later отвечает синхронно: через цикл, чтобы не рекурсировать
+            loop.call_soon(write)
+
+        loop.call_soon(write)
+
+    def stop():
+        nonlocal stopped
+        stopped = True
+
+    def main():
+        for account_id in range(writers):
+            writer(account_id)
+        set_timer(int(seconds * SEC), stop)
+
+    loop.run(main)
+    return done, storage.wal.fsyncs
+
+
+def bench_threads(path, seconds, writers):
+    users, accounts = UserStore(), AccountStore()
+    storage = Storage(path, users, accounts, threading.Lock())
+    storage.load()
+    counts = [0] * writers
+    deadline = time.perf_counter() + seconds
+
+    def writer(n):
+        while time.perf_counter() < deadline:
+            counts[n] += 1
+            with storage.lock:
+                storage.append(OP_USER, n, counts[n], n)
+            storage.commit()
+
+    threads = [threading.Thread(target=writer, args=(n,)) for n in range(writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(counts), storage.wal.fsyncs
+
+
+def bench_write(path, seconds, writers):
+    modes = [
+        ('fsync/write', lambda: bench_loop(path, seconds, writers, 0)),
+        ('group', lambda: bench_loop(path, seconds, writers, GROUP_COMMIT_INTERVAL)),
+        ('threads', lambda: bench_threads(path, seconds, writers)),
+    ]
+    for mode, run in modes:
+        writes, fsyncs = run()
+        print(f'write {mode:>11}: {writes / seconds:9.0f} writes/s  {fsyncs / seconds:7.0f} fsync/s'
+              f'  {writes / max(fsyncs, 1):6.1f} writes/fsync')
+        for name in os.listdir(path):
+            os.remove(os.path.join(path, name))
+
+
+def main(n, seconds, writers, base):
+    path = tempfile.mkdtemp(prefix='bench_persist.', dir=base)
+    try:
+        bench_write(path, seconds, writers)
+        bench_load(path, n)
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--load']:
+        child_load(sys.argv[2])
+    else:
+        main(
+            int(sys.argv[1]) if len(sys.argv) > 1 else 10_000_000,
+            float(sys.argv[2]) if len(sys.argv) > 2 else 5,
+            int(sys.argv[3]) if len(sys.argv) > 3 else 100,
+            sys.argv[4] if len(sys.argv) > 4 else '.',
+        )
@@ -0,0 +1,68 @@
+"""Бенчмарк бэкендов мультиплексора: события в секунду
+
+N пар сокетов играют в пинг-понг: callback читает байт из a и пишет байт в b,
+отчего a снова становится readable. Сравниваем selectors.DefaultSelector,
+select.epoll по уровню и select.epoll с EPOLLET.
+
+usage: python bench_pollers.py [seconds]
+"""
+import resource
+import selectors
+import socket
+import sys
+import time
+
+from event_loop import EventLoop
+from pollers import EpollPoller, SelectorPoller
+
+POLLERS = (
+    ('DefaultSelector', SelectorPoller),
+    ('epoll', lambda: EpollPoller(edge_triggered=False)),
+    ('epoll EPOLLET', EpollPoller),
+)
+
+
+def bench(make_poller, n, seconds):
+    loop = EventLoop(make_poller())
+    pairs = [socket.socketpair() for _ in range(n)]
+    events = 0
+
+    def make_callback(a, b):
+        def on_event(mask):
+            nonlocal events
+            events += 1
+            a.recv(1)
+            b.send(b'x')
+        return on_event
+
+    for a, b in pairs:
+        a.setblocking(False)
+        loop._queue.register_fileobj(a, make_callback(a, b), selectors.EVENT_READ)
+        b.send(b'x')
+
+    deadline = time.monotonic() + seconds
+    start = time.perf_counter()
+    while time.monotonic() < deadline:
+        for _ in range(10):
+            loop._run_once()
+    elapsed = time.perf_counter() - start
+
+    for a, b in pairs:
+        loop._queue.unregister_fileobj(a)
+        a.close()
+        b.close()
+    loop._queue.close()
+    return events / elapsed
+
+
+def main(seconds):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    for n in (1, 100, 5_000):
+        results = [(name, bench(make_poller, n, seconds)) for name, make_poller in POLLERS]
+        print(f'{n:>5} sockets: ' + '  '.join(f'{name} {rate:10.0f} ev/s' for name, rate in results))
+
+
+if __name__ == '__main__':
+    main(float(sys.argv[1]) if len(sys.argv) > 1 else 2)
@@ -0,0 +1,118 @@
+"""Бенчмарк текстового протокола против бинарного (PROTO_BINARY)
+
+codec: стоимость кодирования и разбора на одну операцию и байты на проводе - запрос
+одного пользователя и multi-get на MAX_IDS пользователей и счетов:
+клиент кодирует запрос, сервер разбирает его и собирает ответ (handle_request с теплым
+кешем json против handle_binary_request), клиент разбирает ответ.
+
+e2e: AsyncServer в отдельном процессе, pipelined Client в замкнутом цикле multi-get
+по MAX_IDS пользователей, text против binary.
+
+usage: python bench_protocol.py [seconds]
+"""
+import os
+import sys
+import time
+import timeit
+
+from access_log import OFF, log
+from benchlib import start_server
+from client import Client
+from event_loop import Context, EventLoop
+from protocol import (
+    FRAME, MAX_IDS, decode_binary_reply, decode_reply, encode_binary_request, encode_request,
+)
+from server import RequestHandler
+
+# сколько multi-get держим в полете в e2e
+IN_FLIGHT = 16
+
+
+class BenchHandler(RequestHandler):
+    client_address = ('127.0.0.1', 0)
+
+
+def per_op(func, number):
+    """лучшее время одного вызова из 5 замеров, в мкс"""
+    return min(timeit.repeat(func, number=number, repeat=5)) / number * 1e6
+
+
+def bench_codec():
+    handler = BenchHandler()
+    cases = [
+        ('user', [1]),
+        ('user', list(range(MAX_IDS))),
+        ('account', list(range(1, MAX_IDS + 1))),
+    ]
+    # пользователи 0..MAX_IDS-1 создают счета 1..MAX_IDS; заодно прогреваем кеш json
+    for entity_kind, entity_ids in cases:
+        handler.handle_request(encode_request(entity_kind, entity_ids)[:-1])
+
+    for entity_kind, entity_ids in cases:
+        number = 20_000 // len(entity_ids)
+        req = encode_request(entity_kind, entity_ids)
+        resp = handler.handle_request(req[:-1])
+        bin_req = encode_binary_request(entity_kind, entity_ids)
+        header, body = bin_req[:FRAME.size], bin_req[FRAME.size:]
+        bin_resp = handler.handle_binary_request(header, body)
+        bin_header, bin_body = bin_resp[:FRAME.size], bin_resp[FRAME.size:]
+        assert decode_binary_reply(bin_header, bin_body) == decode_reply(resp)
+
+        rows = [
+            ('text', len(req), len(resp), [
+                per_op(lambda: encode_request(entity_kind, entity_ids), number),
+                per_op(lambda: handler.handle_request(req[:-1]), number),
+                per_op(lambda: decode_reply(resp), number),
+            ]),
+            ('binary', len(bin_req), len(bin_resp), [
+                per_op(lambda: encode_binary_request(entity_kind, entity_ids), number),
+                per_op(lambda: handler.handle_binary_request(header, body), number),
+                per_op(lambda: decode_binary_reply(bin_header, bin_body), number),
+            ]),
+        ]
+        for protocol, req_bytes, resp_bytes, (encode, serve, decode) in rows:
+            print(
+                f'{entity_kind:>7} x{len(entity_ids):<3} {protocol:>6}: req {req_bytes:5} B'
+                f'  resp {resp_bytes:5} B  encode {encode:7.2f} us  server {serve:7.2f} us'
+                f'  decode {decode:7.2f} us'
+            )
+
+
+def bench_e2e(seconds):
+    server, port = start_server('async')
+    try:
+        for binary in (False, True):
+            loop = EventLoop()
+            Context.set_event_loop(loop)
+            client = Client(('127.0.0.1', port), pipeline=True, binary=binary)
+            user_ids = list(range(MAX_IDS))
+            done = 0
+            deadline = time.monotonic() + seconds
+
+            def get(error=None, users=None):
+                nonlocal done
+                if error:
+                    raise error
+                if users is not None:
+                    done += 1
+                if time.monotonic() < deadline:
+                    client.get_users(user_ids, get)
+
+            def main():
+                for _ in range(IN_FLIGHT):
+                    get()
+
+            loop.run(main)
+            client.close()
+            protocol = 'binary' if binary else 'text'
+            print(f'e2e {protocol:>6}: {done / seconds:8.0f} multi-get/s  {done * MAX_IDS / seconds:9.0f} users/s')
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == '__main__':
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    log.level = OFF
+    bench_codec()
+    bench_e2e(float(sys.argv[1]) if len(sys.argv) > 1 else 5)
@@ -0,0 +1,106 @@
+"""Бенчмарк sendall: payload через локальный socketpair
+
+legacy - прежний _socket.sendall: send() и data = data[n:] после каждой частичной записи
+cursor - memoryview курсор и sendmsg
+small  - тот же payload кусками по 4KB, все sendall в одной итерации цикла
+
+Считаем системные вызовы записи и байты, скопированные в python.
+
+usage: python bench_sendall.py [megabytes]
+"""
+import socket
+import sys
+import threading
+import time
+
+from consts import KB
+from event_loop import Context, EventLoop, _socket
+
+
+class CountingSocket(socket.socket):
+    syscalls = 0
+    copied = 0
+
+    def send(self, *args):
+        CountingSocket.syscalls += 1
+        return super().send(*args)
+
+    def sendmsg(self, *args):
+        CountingSocket.syscalls += 1
+        return super().sendmsg(*args)
+
+
+def legacy_sendall(sock, data, callback):
+    """Копия прежней реализации, со счетчиком копирований"""
+    def _on_write_ready(err):
+        nonlocal data
+        if err:
+            return callback(err)
+
+        n = sock._sock.send(data)
+        if n < len(data):
+            data = data[n:]
+            CountingSocket.copied += len(data)
+            sock._callbacks['sent'] = _on_write_ready
+        else:
+            callback(None)
+
+    sock._callbacks['sent'] = _on_write_ready
+    sock._update_events()
+
+
+def drain(sock, total):
+    buf = bytearray(256 * KB)
+    received = 0
+    while received < total:
+        received += sock.recv_into(buf)
+
+
+def bench(mode, payload):
+    a, b = socket.socketpair()
+    counting = CountingSocket(fileno=a.detach())
+    CountingSocket.syscalls = CountingSocket.copied = 0
+    reader = threading.Thread(target=drain, args=(b, len(payload)))
+    reader.start()
+
+    loop = EventLoop()
+    Context.set_event_loop(loop)
+
+    def main():
+        sock = _socket(sock=counting)
+
+        def on_sent(error):
+            assert not error, error
+            sock.close()
+
+        if mode == 'legacy':
+            legacy_sendall(sock, payload, on_sent)
+        elif mode == 'cursor':
+            sock.sendall(payload, on_sent)
+        else:
+            view = memoryview(payload)
+            chunks = [view[i:i + 4 * KB] for i in range(0, len(view), 4 * KB)]
+            for chunk in chunks[:-1]:
+                sock.sendall(chunk, lambda error: None)
+            sock.sendall(chunks[-1], on_sent)
+
+    start = time.perf_counter()
+    loop.run(main)
+    reader.join()
+    elapsed = time.perf_counter() - start
+    b.close()
+    print(
+        f'{mode:>6}: {elapsed:7.3f}s  {len(payload) / elapsed / 2 ** 20:8.1f} MB/s'
+        f'  syscalls {CountingSocket.syscalls:7}  copied {CountingSocket.copied / 2 ** 20:10.1f} MB'
+    )
+
+
+def main(megabytes):
+    payload = bytes(megabytes * 2 ** 20)
+    print(f'{megabytes} MB payload')
+    for mode in ('legacy', 'cursor', 'small'):
+        bench(mode, payload)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 64)
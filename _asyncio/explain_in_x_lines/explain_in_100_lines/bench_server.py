@@ -0,0 +1,119 @@
+"""Нагрузочный тест сервера: ThreadingTCPServer, AsyncServer и prefork (AsyncServer на ядро)
+
+Сервер запускается отдельным процессом (benchlib.start_server: python server.py <port> <mode>,
+вывод в /dev/null, журнал доступа выключен),
+клиенты - несколько процессов с EventLoop, у каждого своя доля соединений.
+Соединение работает в замкнутом цикле: запрос 'GET user <id>', ждем ответ, следующий запрос.
+Соединения поднимаются заранее, замер начинается, когда подключились все.
+Клиенты делят CPU с сервером, так что абсолютные цифры занижены, сравнивать стоит режимы между собой.
+
+usage: python bench_server.py [seconds] [clients...]
+"""
+import multiprocessing
+import os
+import resource
+import socket
+import sys
+import time
+
+from benchlib import start_server
+from event_loop import Context, EventLoop, _socket
+
+MODES = ('threading', 'async', 'prefork')
+WORKERS = 4
+
+
+def worker(port, first_id, n, seconds, barrier, results):
+    loop = EventLoop()
+    Context.set_event_loop(loop)
+    latencies = []
+    errors = 0
+    socks = [socket.create_connection(('127.0.0.1', port)) for _ in range(n)]
+    barrier.wait()
+    deadline = time.monotonic() + seconds
+
+    def run_client(user_id, sock):
+        sock = _socket(sock=sock)
+        req = f'GET user {user_id}\n'.encode('ascii')
+        started = 0
+
+        def send():
+            nonlocal started
+            if time.monotonic() >= deadline:
+                return sock.close()
+            started = time.perf_counter()
+            sock.sendall(req, on_sent)
+            sock.recv_until(b'\n', on_reply)
+
+        def on_sent(error):
+            nonlocal errors
+            if error:
+                errors += 1
+
+        def on_reply(error, resp=None):
+            nonlocal errors
+            if error:
+                errors += 1
+                return sock.close()
+            latencies.append(time.perf_counter() - started)
+            send()
+
+        send()
+
+    def main():
+        for i, sock in enumerate(socks):
+            run_client(first_id + i, sock)
+
+    loop.run(main)
+    results.put((latencies, errors))
+
+
+def bench(mode, clients, seconds):
+    server, port = start_server(mode)
+    workers = min(WORKERS, clients)
+    barrier = multiprocessing.Barrier(workers)
+    results = multiprocessing.Queue()
+    procs = []
+    for i in range(workers):
+        n = clients // workers + (i < clients % workers)
+        proc = multiprocessing.Process(
+            target=worker, args=(port, i * clients, n, seconds, barrier, results),
+        )
+        proc.start()
+        procs.append(proc)
+
+    latencies = []
+    errors = 0
+    for _ in procs:
+        worker_latencies, worker_errors = results.get()
+        latencies += worker_latencies
+        errors += worker_errors
+    for proc in procs:
+        proc.join()
+    # prefork-супервизор по SIGTERM дренирует воркеров
+    server.terminate()
+    server.wait()
+
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2] if latencies else 0
+    p99 = latencies[int(len(latencies) * 0.99)] if latencies else 0
+    print(
+        f'{mode:>9} {clients:>5} clients: {len(latencies) / seconds:9.0f} req/s'
+        f'  p50 {p50 * 1000:8.2f} ms  p99 {p99 * 1000:8.2f} ms  errors {errors}'
+    )
+
+
+def main(seconds, clients):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    for n in clients:
+        for mode in MODES:
+            bench(mode, n, seconds)
+
+
+if __name__ == '__main__':
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    clients = [int(n) for n in sys.argv[2:]] or [1, 100, 1000]
+    main(seconds, clients)
@@ -0,0 +1,80 @@
+"""Бенчмарк памяти хранилища: dict of dicts (как было в Handler) против store.py
+
+Каждый замер - отдельный процесс: создаем n пользователей и n счетов, меряем прирост RSS
+и время случайного get. Процессу ставится лимит адресного пространства (по умолчанию
+половина RAM): не поместившийся вариант сообщит MemoryError, а не уронит машину.
+
+usage: python bench_store.py [entities...]
+"""
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+
+from store import AccountStore, UserStore
+
+LAYOUTS = ('dicts', 'store')
+LOOKUPS = 1_000_000
+
+
+def rss():
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def build_dicts(n):
+    users, accounts = {}, {}
+    for i in range(n):
+        account_id = str(i + 1)
+        accounts[account_id] = {'id': account_id, 'balance': random.randint(0, 100)}
+        users[str(i)] = {'id': str(i), 'name': f'{random.getrandbits(32):08x}', 'account_id': account_id}
+    return users, accounts
+
+
+def build_store(n):
+    users, accounts = UserStore(), AccountStore()
+    for i in range(n):
+        accounts.add(i + 1, random.randint(0, 100))
+        users.add(i, f'{random.getrandbits(32):08x}', i + 1)
+    return users, accounts
+
+
+def child(layout, n):
+    limit = os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') // 2
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+    before = rss()
+    try:
+        users, accounts = (build_dicts if layout == 'dicts' else build_store)(n)
+    except MemoryError:
+        # печатаем после except: traceback держит недостроенные словари
+        users = None
+    if users is None:
+        print(f'{layout:>5} {n:>10}: MemoryError (limit {limit / 2 ** 30:.1f} GB)')
+        return
+    used = rss() - before
+
+    ids = [str(random.randrange(n)) for _ in range(LOOKUPS)]
+    start = time.perf_counter()
+    for user_id in ids:
+        users.get(user_id)
+    elapsed = time.perf_counter() - start
+    print(
+        f'{layout:>5} {n:>10}: {used / 2 ** 20:9.1f} MB  {used / n:6.1f} B/entity'
+        f'  get {elapsed / LOOKUPS * 1e9:6.0f} ns'
+    )
+
+
+def main(sizes):
+    for n in sizes:
+        for layout in LAYOUTS:
+            subprocess.run([sys.executable, __file__, '--child', layout, str(n)])
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--child']:
+        child(sys.argv[2], int(sys.argv[3]))
+    else:
+        main([int(n) for n in sys.argv[1:]] or [1_000_000, 10_000_000])
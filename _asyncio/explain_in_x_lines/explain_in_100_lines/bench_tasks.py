@@ -0,0 +1,138 @@
+"""Бенчмарк сопрограмм (Task, Client.fetch) против callbacks (Client.get_user/get_balance)
+
+Сценарий client.main без случайных задержек: get_user, затем get_balance его счета,
+через пул соединений Client. clients параллельных сценариев в замкнутом цикле.
+
+throughput: против AsyncServer в отдельном процессе, сценариев и запросов в секунду.
+
+inflight: сколько блоков памяти держит запрос, ждущий ответа - closures callback-версии
+против кадра сопрограммы, Task и Future. Python не считает выделения памяти, поэтому
+меряем то, что живет, пока запрос ждет: сервер - слушающий сокет, который никогда не
+отвечает, прирост sys.getallocatedblocks() и объектов под gc (closures, cells, кадры
+сопрограмм, Future) на запрос в полете, вместе с соединением.
+Каждый замер - отдельный процесс.
+
+usage: python bench_tasks.py [seconds] [clients]
+"""
+import gc
+import os
+import socket
+import subprocess
+import sys
+import time
+
+from access_log import OFF, log
+from benchlib import start_server
+from client import Client
+from consts import MS
+from event_loop import Context, EventLoop, set_timer
+
+STYLES = ('callbacks', 'coroutines')
+
+
+def run_callbacks(client, user_id, done, repeat):
+    def on_user(error, user=None):
+        if error:
+            raise error
+
+        def on_account(error, account=None):
+            if error:
+                raise error
+            done()
+            if repeat():
+                run_callbacks(client, user_id, done, repeat)
+
+        client.get_balance(user['account_id'], on_account)
+
+    client.get_user(user_id, on_user)
+
+
+async def run_coroutine(client, user_id, done, repeat):
+    while True:
+        user = await client.fetch('user', user_id)
+        await client.fetch('account', user['account_id'])
+        done()
+        if not repeat():
+            return
+
+
+def start(style, client, clients, done, repeat):
+    loop = client.evloop
+    for user_id in range(clients):
+        if style == 'callbacks':
+            run_callbacks(client, user_id, done, repeat)
+        else:
+            loop.create_task(run_coroutine(client, user_id, done, repeat))
+
+
+def bench_throughput(style, port, seconds, clients):
+    loop = EventLoop()
+    Context.set_event_loop(loop)
+    client = Client(('127.0.0.1', port), max_connections=clients)
+    flows = 0
+    deadline = time.monotonic() + seconds
+
+    def done():
+        nonlocal flows
+        flows += 1
+
+    def repeat():
+        return time.monotonic() < deadline
+
+    loop.run(start, style, client, clients, done, repeat)
+    client.close()
+    print(f'throughput {style:>10}: {flows / seconds:8.0f} flows/s  {2 * flows / seconds:8.0f} req/s')
+
+
+def child_inflight(style, clients):
+    # сервер, который принимает соединения ядром (backlog) и никогда не отвечает
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(clients + 1)
+    loop = EventLoop()
+    Context.set_event_loop(loop)
+    client = Client(server.getsockname(), max_connections=clients)
+
+    def measure():
+        used = sys.getallocatedblocks() - before
+        objects = len(gc.get_objects()) - before_objects
+        print(
+            f'inflight   {style:>10}: {used / clients:8.1f} blocks'
+            f'  {objects / clients:6.1f} gc objects per waiting request'
+        )
+        sys.stdout.flush()
+        # запросы ждут вечно, цикл сам не закончится
+        os._exit(0)
+
+    def main():
+        start(style, client, clients, lambda: None, lambda: False)
+        set_timer(200 * MS, measure)
+
+    gc.collect()
+    before = sys.getallocatedblocks()
+    before_objects = len(gc.get_objects())
+    loop.run(main)
+
+
+def main(seconds, clients):
+    server, port = start_server('async')
+    try:
+        for style in STYLES:
+            bench_throughput(style, port, seconds, clients)
+    finally:
+        server.terminate()
+        server.wait()
+    for style in STYLES:
+        subprocess.run([sys.executable, __file__, '--inflight', style, str(clients)])
+
+
+if __name__ == '__main__':
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    log.level = OFF
+    if sys.argv[1:2] == ['--inflight']:
+        child_inflight(sys.argv[2], int(sys.argv[3]))
+    else:
+        main(
+            float(sys.argv[1]) if len(sys.argv) > 1 else 5,
+            int(sys.argv[2]) if len(sys.argv) > 2 else 100,
+        )
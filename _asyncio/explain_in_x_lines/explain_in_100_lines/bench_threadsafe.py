@@ -0,0 +1,154 @@
+"""Бенчмарк передачи работы в EventLoop из других потоков
+
+threadsafe: call_soon_threadsafe, waker на eventfd и на self-pipe.
+polling: как было - producer кладет в queue.Queue, цикл разбирает ее таймером раз в POLL.
+
+latency: один producer, пауза между вызовами - цикл успевает заснуть в select;
+время от вызова в producer'е до callback'а в цикле.
+throughput: producers потоков шлют по SUBMITS вызовов без пауз; callbacks в секунду
+и сколько их приходится на одно пробуждение цикла (сброс waker'а).
+
+usage: python bench_threadsafe.py [producers]
+"""
+import functools
+import queue
+import sys
+import threading
+import time
+
+import event_loop
+from consts import MS
+from event_loop import Context, EventLoop, Future, set_timer
+
+LATENCY_SAMPLES = 2000
+PAUSE = 0.0002
+SUBMITS = 100_000
+POLL = MS
+
+
+class CountingWaker(event_loop._Waker):
+    """clear зовется раз на пробуждение цикла"""
+    wakeups = 0
+
+    def clear(self):
+        CountingWaker.wakeups += 1
+        super().clear()
+
+
+def threadsafe(loop):
+    return loop.call_soon_threadsafe
+
+
+def polling(loop):
+    """submit для producer'ов и таймер, который разбирает их очередь"""
+    inbox = queue.SimpleQueue()
+    stopped = False
+
+    def drain():
+        while True:
+            try:
+                callback, args = inbox.get_nowait()
+            except queue.Empty:
+                break
+            callback(*args)
+        if not stopped:
+            set_timer(POLL, drain)
+
+    def stop():
+        nonlocal stopped
+        stopped = True
+
+    set_timer(POLL, drain)
+    submit = lambda callback, *args: inbox.put((callback, args))
+    submit.stop = stop
+    return submit
+
+
+def run(make_submit, producer, expected):
+    """producer(submit, on_loop) в отдельных потоках; цикл работает, пока не выполнит expected вызовов"""
+    loop = EventLoop()
+    Context.set_event_loop(loop)
+    CountingWaker.wakeups = 0
+
+    async def main():
+        submit = make_submit(loop)
+        finished = Future()
+        count = 0
+
+        def on_loop(callback, *args):
+            nonlocal count
+            callback(*args)
+            count += 1
+            if count == expected:
+                finished.set_result(None)
+
+        threads = producer(submit, on_loop)
+        await finished
+        if hasattr(submit, 'stop'):
+            submit.stop()
+        for thread in threads:
+            thread.join()
+
+    started = time.perf_counter()
+    loop.run(main)
+    return time.perf_counter() - started
+
+
+def bench_latency(name, make_submit):
+    latencies = []
+
+    def record(sent):
+        latencies.append(time.perf_counter() - sent)
+
+    def producer(submit, on_loop):
+        def work():
+            for _ in range(LATENCY_SAMPLES):
+                time.sleep(PAUSE)
+                submit(on_loop, record, time.perf_counter())
+
+        thread = threading.Thread(target=work)
+        thread.start()
+        return [thread]
+
+    run(make_submit, producer, LATENCY_SAMPLES)
+    latencies.sort()
+    print(
+        f'latency    {name:>16}: p50 {latencies[len(latencies) // 2] * 1e6:7.1f} us'
+        f'  p99 {latencies[len(latencies) * 99 // 100] * 1e6:7.1f} us'
+    )
+
+
+def bench_throughput(name, make_submit, producers):
+    def producer(submit, on_loop):
+        def work():
+            for _ in range(SUBMITS):
+                submit(on_loop, int)
+
+        threads = [threading.Thread(target=work) for _ in range(producers)]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    total = SUBMITS * producers
+    elapsed = run(make_submit, producer, total)
+    batch = ''
+    if make_submit is threadsafe:
+        batch = f'{total / max(CountingWaker.wakeups, 1):8.0f} callbacks per wakeup'
+    print(f'throughput {name:>16}: {producers} producers  {total / elapsed:9.0f} callbacks/s  {batch}')
+
+
+def main(producers):
+    variants = [
+        ('threadsafe eventfd', threadsafe, True),
+        ('threadsafe pipe', threadsafe, False),
+        ('polling', polling, True),
+    ]
+    for name, make_submit, use_eventfd in variants:
+        event_loop._Waker = functools.partial(CountingWaker, use_eventfd=use_eventfd)
+        name = name.replace('threadsafe ', '')
+        bench_latency(name, make_submit)
+        bench_throughput(name, make_submit, producers)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 4)
@@ -0,0 +1,97 @@
+"""Микробенчмарк: heapq очередь таймеров (как было в Queue) против TimerWheel
+
+Сценарий как у генератора нагрузки: N таймаутов в пределах минуты,
+почти все отменяются до срабатывания, остальные дожидаются срока.
+
+usage: python bench_timers.py [cancel_ratio]
+"""
+import heapq
+import random
+import sys
+import time
+
+from consts import MS, SEC
+from timers import TimerWheel
+
+
+class HeapTimers:
+    """Прежняя реализация: heapq и ленивая отмена флагом в записи"""
+    def __init__(self):
+        self._timers = []
+        self._timer_no = 0
+
+    def add(self, when, callback):
+        timer = [when, self._timer_no, callback, False]
+        heapq.heappush(self._timers, timer)
+        self._timer_no += 1
+        return timer
+
+    @staticmethod
+    def cancel(timer):
+        timer[3] = True
+
+    def expire(self, now):
+        expired = []
+        while self._timers and self._timers[0][0] <= now:
+            timer = heapq.heappop(self._timers)
+            if not timer[3]:
+                expired.append(timer)
+        return expired
+
+
+class WheelTimers:
+    def __init__(self):
+        self._wheel = TimerWheel(0, MS)
+
+    def add(self, when, callback):
+        return self._wheel.add(when, callback)
+
+    @staticmethod
+    def cancel(handle):
+        handle.cancel()
+
+    def expire(self, now):
+        return self._wheel.expire(now)
+
+
+def bench(cls, deadlines, cancel_ratio):
+    timers = cls()
+    noop = object()
+
+    start = time.perf_counter()
+    handles = [timers.add(when, noop) for when in deadlines]
+    insert = time.perf_counter() - start
+
+    to_cancel = handles[:int(len(handles) * cancel_ratio)]
+    start = time.perf_counter()
+    for handle in to_cancel:
+        timers.cancel(handle)
+    cancel = time.perf_counter() - start
+
+    # цикл событий "тикает" раз в 10ms до последнего срока
+    fired = 0
+    start = time.perf_counter()
+    for now in range(0, 61 * SEC, 10 * MS):
+        fired += len(timers.expire(now))
+    expire = time.perf_counter() - start
+
+    return insert, cancel, expire, fired
+
+
+def main(cancel_ratio):
+    for n in (10 ** 4, 10 ** 5, 10 ** 6):
+        rnd = random.Random(n)
+        deadlines = [rnd.randrange(60 * SEC) for _ in range(n)]
+        print(f'{n} pending timers, {cancel_ratio:.0%} cancelled')
+        for name, cls in (('heap', HeapTimers), ('wheel', WheelTimers)):
+            insert, cancel, expire, fired = bench(cls, deadlines, cancel_ratio)
+            print(
+                f'  {name:>5}: insert {insert / n * 1e9:7.0f} ns/op'
+                f'  cancel {cancel / max(n * cancel_ratio, 1) * 1e9:6.0f} ns/op'
+                f'  expire {expire:6.3f} s total'
+                f'  fired {fired}'
+            )
+
+
+if __name__ == '__main__':
+    main(float(sys.argv[1]) if len(sys.argv) > 1 else 0.95)
@@ -0,0 +1,45 @@
+"""Общее для бенчмарков: сервер в отдельном процессе
+
+    server, port = start_server('prefork', '4')  # python server.py <port> prefork 4
+    ...
+    server.terminate()
+    server.wait()
+
+Журнал доступа у сервера выключен (ACCESS_LOG_LEVEL=off): иначе бенчмарк мерил бы
+и форматирование записей, и вывод в /dev/null.
+"""
+import os
+import socket
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+# сколько ждем, пока сервер начнет принимать соединения
+START_TIMEOUT = 5
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(*mode):
+    """python server.py <port> *mode -> (Popen, port), когда порт уже принимает соединения"""
+    port = free_port()
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, 'server.py'), str(port), *mode],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd=HERE,
+        env=dict(os.environ, ACCESS_LOG_LEVEL='off'),
+    )
+    deadline = time.monotonic() + START_TIMEOUT
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return server, port
+        except ConnectionRefusedError:
+            if time.monotonic() > deadline:
+                server.kill()
+                raise
+            time.sleep(0.05)
@@ -0,0 +1,50 @@
+"""LRU кеш закодированных ответов
+
+Пользователь после создания не меняется, счет - только при записи баланса, поэтому
+json сущности можно закодировать один раз и дальше отдавать готовые байты.
+Изменяющий сущность код обязан вызвать invalidate.
+"""
+import collections
+
+
+class LRUCache:
+    """Ограниченный словарь: при переполнении выкидывается давно не читанный ключ.
+    max_size=0 - кеш выключен
+
+    Без блокировок: в ThreadingTCPServer гонка приводит самое большее к промаху
+    и повторному кодированию"""
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._data = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        try:
+            self._data.move_to_end(key)
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if not self.max_size:
+            return
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            try:
+                self._data.popitem(last=False)
+            except KeyError:
+                break
+
+    def invalidate(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
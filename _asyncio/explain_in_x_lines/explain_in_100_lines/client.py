@@ -1,56 +1,469 @@
+import collections
 import sys
 
 import random
 
-import json
-
-from consts import KB
-from event_loop import _socket, set_timer, Context, EventLoop
+from consts import SEC
+from event_loop import (
+    WRITE_HIGH_WATER, _socket, set_timer, Context, EventLoop, from_callback, gather, sleep,
+    sock_recv_exactly, sock_recv_until, sock_sendall,
+)
+from protocol import (
+    DELIMITER, FRAME, MAX_IDS, PROTO_BINARY, ReplyError,
+    decode_binary_reply, decode_reply, encode_binary_request, encode_request, request_ids,
+)
 import socket
 
 
-class Client:
-    def __init__(self, addr):
+def recv_reply(sock, binary, callback):
+    """callback(error, data) - разобранный ответ. ReplyError - сервер ответил ошибкой,
+    соединение при этом исправно"""
+    if binary:
+        def _on_header(error, header=None):
+            if error:
+                return callback(error)
+            # header - memoryview на буфер сокета, следующее чтение его перезапишет
+            header = bytes(header)
+
+            def _on_body(error, body=None):
+                if error:
+                    return callback(error)
+                try:
+                    data = decode_binary_reply(header, body)
+                except ReplyError as error:
+                    return callback(error)
+                callback(None, data)
+
+            sock.recv_exactly(FRAME.unpack(header)[0], _on_body)
+
+        return sock.recv_exactly(FRAME.size, _on_header)
+
+    def _on_frame(error, frame=None):
+        if error:
+            return callback(error)
+        try:
+            data = decode_reply(frame)
+        except ReplyError as error:
+            return callback(error)
+        callback(None, data)
+
+    sock.recv_until(DELIMITER, _on_frame)
+
+
+def negotiate(sock, callback):
+    """Предлагаем серверу бинарный протокол; callback(error, binary) - перешли ли на него"""
+    def _on_reply(error, data=None):
+        if isinstance(error, ReplyError):
+            # сервер не умеет, остаемся на тексте
+            return callback(None, False)
+        if error:
+            return callback(error)
+        callback(None, True)
+
+    # ошибку отправки увидим при чтении ответа
+    sock.sendall(PROTO_BINARY + DELIMITER, lambda error: None)
+    recv_reply(sock, False, _on_reply)
+
+
+class ConnectionPool(Context):
+    """Пул keep-alive соединений к одному адресу
+
+    max_size - сколько соединений держим открытыми (занятые + свободные), сверх этого
+    запросы ждут освобождения; idle_timeout - сколько свободное соединение живет в пуле.
+    Перед выдачей свободное соединение проверяется: не закрыл ли его сервер.
+    binary - предлагать серверу бинарный протокол; если отказал, сбрасывается в False
+    """
+    def __init__(self, addr, max_size=10, idle_timeout=30 * SEC, binary=False):
         self.addr = addr
-    
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.binary = binary
+        # (sock, released_at), берем с конца - самые свежие
+        self._idle = collections.deque()
+        self._waiters = collections.deque()
+        self._size = 0
+
+    def acquire(self, callback):
+        """callback(error, sock)"""
+        now = self.evloop.time()
+        while self._idle:
+            sock, released_at = self._idle.pop()
+            if now - released_at <= self.idle_timeout and sock.is_alive():
+                return callback(None, sock)
+            self._discard(sock)
+
+        if self._size < self.max_size:
+            self._connect(callback)
+        else:
+            self._waiters.append(callback)
+
+    def release(self, sock, reuse=True):
+        """reuse=False - соединение в непонятном состоянии (ошибка посреди запроса), закрываем"""
+        if not reuse:
+            self._discard(sock)
+            self._connect_waiter()
+        elif self._waiters:
+            self._waiters.popleft()(None, sock)
+        else:
+            self._idle.append((sock, self.evloop.time()))
+
+    def close(self):
+        while self._idle:
+            sock, _ = self._idle.pop()
+            self._discard(sock)
+
+    def _connect(self, callback):
+        self._size += 1
+        sock = _socket(socket.AF_INET, socket.SOCK_STREAM)
+
+        def _on_conn(error):
+            if error:
+                # _socket закрывается сам, если подключиться не удалось
+                self._size -= 1
+                # место освободилось - ждущий пробует подключиться сам, а не висит
+                self._connect_waiter()
+                return callback(error)
+            if not self.binary:
+                return callback(None, sock)
+
+            def _on_negotiated(error, binary=None):
+                if error:
+                    self._discard(sock)
+                    self._connect_waiter()
+                    return callback(error)
+                self.binary = binary
+                callback(None, sock)
+
+            negotiate(sock, _on_negotiated)
+
+        sock.connect(self.addr, _on_conn)
+
+    def _connect_waiter(self):
+        if self._waiters:
+            self._connect(self._waiters.popleft())
+
+    def _discard(self, sock):
+        sock.close()
+        self._size -= 1
+
+
+class PipelinedConnection(Context):
+    """Одно соединение, по которому запросы уходят пачкой, не дожидаясь ответов
+
+    Запросы, накопленные за итерацию цикла, отправляются одним sendall; ответы приходят
+    в том же порядке и раздаются callbacks по очереди. Соединение открывается при первом
+    запросе и переоткрывается после ошибки. Пока буфер записи сокета выше high water
+    (сервер не успевает читать), новые запросы копятся в _outbox и не отправляются
+    """
+    def __init__(self, addr, binary=False):
+        self.addr = addr
+        self.binary = binary
+        self._sock = None
+        self._connected = False
+        # (entity_kind, entity_id, callback) текущей итерации, еще не отправленные; кодируем
+        # при отправке, когда протокол соединения уже согласован
+        self._outbox = collections.deque()
+        # callbacks отправленных запросов в порядке отправки
+        self._waiting = collections.deque()
+        # отправлено, но ответ еще не получен
+        self._in_flight = 0
+        self._reading = False
+        # буфер записи сокета выше high water - не отправляем до resume_writing
+        self._paused = False
+
+    def request(self, entity_kind, entity_id, callback):
+        """callback(error, data) - разобранный ответ"""
+        self._outbox.append((entity_kind, entity_id, callback))
+        if len(self._outbox) == 1:
+            self.evloop.call_soon(self._flush)
+
+    def close(self):
+        if self._sock is not None and not self._waiting and not self._outbox:
+            self._sock.close()
+            self._sock = None
+            self._connected = False
+
+    def _flush(self):
+        if self._sock is None:
+            return self._connect()
+        encode = encode_binary_request if self.binary else encode_request
+        # пачками около WRITE_HIGH_WATER: после каждого sendall сокет мог попросить паузу,
+        # и буфер записи не уходит за high water больше чем на одну пачку
+        while self._connected and self._outbox and not self._paused:
+            frames = []
+            size = 0
+            while self._outbox and size < WRITE_HIGH_WATER:
+                entity_kind, entity_id, callback = self._outbox.popleft()
+                # кодируем до учета в _waiting/_in_flight: запрос, который не закодировать,
+                # падает один, очередь ответов остальных не сдвигается
+                try:
+                    frame = encode(entity_kind, entity_id)
+                except ValueError as error:
+                    self.evloop.call_soon(callback, error)
+                    continue
+                frames.append(frame)
+                size += len(frame)
+                self._waiting.append(callback)
+            if frames:
+                self._in_flight += len(frames)
+                self._sock.sendall(frames, self._on_sent)
+        self._read()
+
+    def _connect(self):
+        self._sock = _socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.set_flow_control(self._pause_writing, self._resume_writing)
+
+        def _on_conn(error):
+            if error:
+                # _socket закрывается сам, если подключиться не удалось
+                self._sock = None
+                return self._fail(error)
+            if not self.binary:
+                return _on_negotiated(None, False)
+            negotiate(self._sock, _on_negotiated)
+
+        def _on_negotiated(error, binary=None):
+            if error:
+                return self._fail(error)
+            self.binary = binary
+            self._connected = True
+            self._flush()
+
+        self._sock.connect(self.addr, _on_conn)
+
+    def _pause_writing(self):
+        self._paused = True
+
+    def _resume_writing(self):
+        self._paused = False
+        # отложенное за паузу - следующей итерацией, не изнутри записи сокета
+        if self._outbox:
+            self.evloop.call_soon(self._flush)
+
+    def _on_sent(self, error):
+        if error:
+            self._fail(error)
+
+    def _read(self):
+        # читаем только пока ждем ответов: простаивающее соединение не должно держать цикл
+        if not self._reading and self._in_flight:
+            self._reading = True
+            recv_reply(self._sock, self.binary, self._on_reply)
+
+    def _on_reply(self, error, data=None):
+        self._reading = False
+        # ReplyError - ошибка одного запроса, соединение исправно
+        if error and not isinstance(error, ReplyError):
+            return self._fail(error)
+        self._in_flight -= 1
+        callback = self._waiting.popleft()
+        self._read()
+        callback(error, data)
+
+    def _fail(self, error):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+        self._connected = False
+        self._reading = False
+        self._paused = False
+        self._in_flight = 0
+        waiting, self._waiting = self._waiting, collections.deque()
+        waiting.extend(callback for _, _, callback in self._outbox)
+        self._outbox = collections.deque()
+        for callback in waiting:
+            callback(error)
+
+
+class Client(Context):
+    def __init__(
+        self, addr, max_connections=10, idle_timeout=30 * SEC, pipeline=False, batch=False, binary=False,
+    ):
+        """pipeline=True - все запросы к адресу идут по одному соединению без ожидания ответов
+        batch=True - get_user/get_balance за итерацию цикла склеиваются в один multi-get
+        binary=True - предлагать серверу бинарный протокол, при отказе остаемся на тексте"""
+        self.addr = addr
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.pipeline = pipeline
+        self.batch = batch
+        self.binary = binary
+        # addr -> ConnectionPool
+        self._pools = {}
+        # addr -> PipelinedConnection
+        self._pipelines = {}
+        # entity_kind -> [(entity_id, callback)], копятся до конца итерации
+        self._batches = {}
+
+    def close(self):
+        for pool in self._pools.values():
+            pool.close()
+        for pipeline in self._pipelines.values():
+            pipeline.close()
+
+    def _get_pool(self, addr):
+        pool = self._pools.get(addr)
+        if pool is None:
+            pool = self._pools[addr] = ConnectionPool(
+                addr, self.max_connections, self.idle_timeout, self.binary,
+            )
+        return pool
+
+    def _get_pipeline(self, addr):
+        pipeline = self._pipelines.get(addr)
+        if pipeline is None:
+            pipeline = self._pipelines[addr] = PipelinedConnection(addr, self.binary)
+        return pipeline
+
     def get_user(self, user_id, callback):
-        self._get(f'GET user {user_id}\n', callback)
+        self._get_one('user', user_id, callback)
     
     def get_balance(self, account_id, callback):
-        self._get(f'GET account {account_id}\n', callback)
+        self._get_one('account', account_id, callback)
 
-    def _get(self, req, callback):  # request?
-        # регистрируем event_loop._queue.register_fileobj(_socket, _socket.callbacks[...])
-        sock = _socket(socket.AF_INET, socket.SOCK_STREAM)
+    def get_users(self, user_ids, callback):
+        """callback(error, users) - users в порядке user_ids"""
+        self._get_many('user', list(user_ids), callback)
 
-        def _on_conn(error):
+    def get_balances(self, account_ids, callback):
+        """callback(error, accounts) - accounts в порядке account_ids"""
+        self._get_many('account', list(account_ids), callback)
+
+    def _get_one(self, entity_kind, entity_id, callback):
+        # негодный id проверяем до склейки: в multi-get он уронил бы всю пачку
+        try:
+            request_ids(entity_id)
+        except ValueError as error:
+            return self.evloop.call_soon(callback, error)
+        if not self.batch:
+            return self._get(entity_kind, entity_id, callback)
+
+        batch = self._batches.setdefault(entity_kind, [])
+        batch.append((entity_id, callback))
+        if len(batch) == 1:
+            self.evloop.call_soon(self._flush_batch, entity_kind)
+
+    def _flush_batch(self, entity_kind):
+        batch = self._batches.pop(entity_kind)
+
+        def _on_reply(error, entities=None):
+            if isinstance(error, ReplyError) and len(batch) > 1:
+                # на multi-get сервер отвечает одной ошибкой на всех (например, одного id нет):
+                # переспрашиваем по одному, чтобы ошибка досталась только своему вызову
+                for entity_id, callback in batch:
+                    self._get(entity_kind, entity_id, callback)
+                return
+            # каждый callback отдельно через цикл: исключение в одном не помешает остальным
+            for n, (_, callback) in enumerate(batch):
+                if error:
+                    self.evloop.call_soon(callback, error)
+                else:
+                    self.evloop.call_soon(callback, None, entities[n])
+
+        self._get_many(entity_kind, [entity_id for entity_id, _ in batch], _on_reply)
+
+    def _get_many(self, entity_kind, entity_ids, callback):
+        # длинный список режем на запросы по MAX_IDS id, с pipeline они уйдут одним sendall
+        chunks = [entity_ids[i:i + MAX_IDS] for i in range(0, len(entity_ids), MAX_IDS)]
+        if not chunks:
+            return self.evloop.call_soon(callback, None, [])
+
+        results = [None] * len(chunks)
+        pending = len(chunks)
+        failed = False
+
+        for n, chunk in enumerate(chunks):
+            def _on_reply(error, entities=None, n=n, single=len(chunk) == 1):
+                nonlocal pending, failed
+                if failed:
+                    return
+                if error:
+                    failed = True
+                    return callback(error)
+
+                # на запрос с одним id сервер отвечает объектом, а не массивом
+                results[n] = [entities] if single else entities
+                pending -= 1
+                if not pending:
+                    callback(None, [entity for entities in results for entity in entities])
+
+            self._get(entity_kind, chunk, _on_reply)
+
+    def _get(self, entity_kind, entity_id, callback):  # request?
+        """entity_id - id или список id; callback(error, data)"""
+        try:
+            request_ids(entity_id)
+        except ValueError as error:
+            return self.evloop.call_soon(callback, error)
+        if self.pipeline:
+            return self._get_pipeline(self.addr).request(entity_kind, entity_id, callback)
+
+        # соединение берем из пула; после ответа оно возвращается туда же для следующих запросов
+        pool = self._get_pool(self.addr)
+
+        def _on_conn(error, sock=None):
             if error:
                 return callback(error)
 
             def _on_sent(error):
                 if error:
-                    sock.close()
+                    pool.release(sock, reuse=False)
                     return callback(error)
 
-                def _on_resp(error, resp=None):
-                    sock.close()  #?
+                def _on_resp(error, data=None):
+                    # ответ разобран до возврата соединения в пул: буфер сокета больше не нужен
                     if error:
+                        # ReplyError - ошибка только у запроса, соединение исправно
+                        pool.release(sock, reuse=isinstance(error, ReplyError))
                         return callback(error)
-                    callback(None, json.loads(resp))
+                    pool.release(sock)
+                    callback(None, data)
 
-                sock.recv(KB, _on_resp)
+                recv_reply(sock, pool.binary, _on_resp)
 
-            sock.sendall(req.encode('utf-8'), _on_sent)  #?
-        # Регистрируем on_conn в _socket
-        # и _sock.connect() должен быть запущен
-        # начиная с этого момента и до завершения процедуры подключения - нам
-        # нечего делать в скрипте -> event loop должен обрабатывать эту приостановку(?)
-        # пробрасывает это в
-        sock.connect(self.addr, _on_conn)
+            encode = encode_binary_request if pool.binary else encode_request
+            try:
+                request = encode(entity_kind, entity_id)
+            except ValueError as error:
+                pool.release(sock)
+                return callback(error)
+            sock.sendall(request, _on_sent)  #?
+        # подключение (если свободного соединения нет) и ожидание места в пуле
+        # event loop обрабатывает как любую другую приостановку
+        pool.acquire(_on_conn)
+
+    async def fetch(self, entity_kind, entity_id):
+        """Сопрограммный get: user = await client.fetch('user', 1). Путь через пул - тот же
+        _get, но одним кадром стека вместо вложенных closures"""
+        if self.pipeline or self.batch:
+            return await from_callback(self._get_one, entity_kind, entity_id)
 
+        request_ids(entity_id)
+        pool = self._get_pool(self.addr)
+        sock = await from_callback(pool.acquire)
+        encode = encode_binary_request if pool.binary else encode_request
+        try:
+            await sock_sendall(sock, encode(entity_kind, entity_id))
+            # задача продолжается прямо из callback'а чтения: memoryview еще действителен,
+            # и ответ разобран до возврата соединения в пул
+            if pool.binary:
+                header = bytes(await sock_recv_exactly(sock, FRAME.size))
+                body = await sock_recv_exactly(sock, FRAME.unpack(header)[0])
+                data = decode_binary_reply(header, body)
+            else:
+                data = decode_reply(await sock_recv_until(sock, DELIMITER))
+        except ReplyError:
+            # ошибка только у запроса, соединение исправно
+            pool.release(sock)
+            raise
+        except Exception:
+            pool.release(sock, reuse=False)
+            raise
+        pool.release(sock)
+        return data
 
-def get_user_balance(serv_addr, user_id, done):
-    client = Client(serv_addr)
+
+def get_user_balance(client, user_id, done):
 
     def on_timer():
 
@@ -66,19 +479,43 @@ def get_user_balance(serv_addr, user_id, done):
             if user_id % 5 == 0:
                 raise Exception('Do not throw from callbacks')
 
+            # тот же адрес - запрос уйдет по соединению, освобожденному после get_user
+            client.get_balance(user['account_id'], on_account)
+
         client.get_user(user_id, on_user)
     # is event_loop._queue.regiter_timer(hrtime() + rand, on_timer)
-    set_timer(random.randint(0, 10e6), on_timer)
+    set_timer(random.randint(0, SEC), on_timer)
+
+
+async def get_user_balance_async(client, user_id):
+    """То же, что get_user_balance, сопрограммой"""
+    await sleep(random.randint(0, SEC))
+    user = await client.fetch('user', user_id)
+    if user_id % 5 == 0:
+        # исключение уходит ожидающей сопрограмме, а не в цикл
+        raise Exception('Raised inside a coroutine')
+    account = await client.fetch('account', user['account_id'])
+    return f'User {user["name"]} has {account["balance"]} USD'
+
+
+async def main_async(client):
+    async def report(user_id):
+        try:
+            print(await get_user_balance_async(client, user_id))
+        except Exception as error:
+            print(f'Error {error}')
+
+    await gather(*(report(i) for i in range(10)))
 
 
-def main(serv_addr):
+def main(client):
     def on_balance(error, balance=None):
         if error:
             print(f'Error {error}')
         print(balance)
 
     for i in range(10):
-        get_user_balance(serv_addr, i, on_balance)
+        get_user_balance(client, i, on_balance)
 
 
 if __name__ == '__main__':
@@ -86,4 +523,8 @@ if __name__ == '__main__':
     Context.set_event_loop(event_loop)
 
     serv_addr = ('127.0.0.1', int(sys.argv[1]))
-    event_loop.run(main, serv_addr)
+    # callbacks или coroutines - тот же сценарий на async/await
+    style = sys.argv[2] if len(sys.argv) > 2 else 'callbacks'
+    client = Client(serv_addr, pipeline=True, batch=True)
+    event_loop.run(main_async if style == 'coroutines' else main, client)
+    client.close()
@@ -1 +1,6 @@
-KB = 1024
\ No newline at end of file
+KB = 1024
+
+# единица времени цикла (hrtime) - наносекунда
+US = 1_000
+MS = 1_000_000
+SEC = 1_000_000_000
@@ -1,34 +1,66 @@
 import collections
+import concurrent.futures
 import sys
 
 import errno
-import heapq
+import functools
+import inspect
+import itertools
+import os
 # селекторы - высокоуровневая облочка для мультиплексирования
 import selectors
+import signal
 import socket
+import threading
 import time
 
-from consts import KB
+from consts import KB, MS, SEC
+from pollers import SelectorPoller
+from timers import TimerWheel
+
+# начальный размер приемного буфера сокета, растет по необходимости
+RECV_BUFSIZE = 4 * KB
+# сколько буферов отдаем в один sendmsg (UIO_MAXIOV в linux)
+IOV_MAX = 1024
+# водяные знаки буфера записи по умолчанию, как у транспортов asyncio
+WRITE_HIGH_WATER = 64 * KB
+WRITE_LOW_WATER = 16 * KB
+# сколько соединений принимаем за одно событие слушающего сокета, как backlog в asyncio
+ACCEPT_BATCH = 100
+
+
+class _LoopLocal(threading.local):
+    event_loop = None
 
 
 class Context:
     """Context class is an execution context, providing a placeholder for
-     the event loop reference"""
-    _event_loop = None
+     the event loop reference
+
+    Цикл у каждого потока свой: set_event_loop и EventLoop.run ставят его текущему потоку.
+    evloop - цикл вызывающего потока; _socket, set_timer и Task запоминают его при создании
+    (_loop) и остаются привязаны к нему. Трогать их из чужого потока все равно нельзя -
+    только через call_soon_threadsafe их цикла"""
+    _current = _LoopLocal()
 
     class state:
         INITIAL = 0
         CONNECTING = 1
         CONNECTED = 2
         CLOSED = 3
+        LISTENING = 4
 
     @classmethod
     def set_event_loop(cls, event_loop):
-        cls._event_loop = event_loop
+        cls._current.event_loop = event_loop
+
+    @classmethod
+    def get_event_loop(cls):
+        return cls._current.event_loop
 
     @property  # упростить
     def evloop(self):
-        return self._event_loop
+        return self._current.event_loop
 
 
 class _socket(Context):
@@ -39,13 +71,49 @@ class _socket(Context):
     error occured
     -> el будет вызывать соответствующий callback
     """
-    def __init__(self, *args):
-        self._sock = socket.socket(*args)
+    def __init__(self, *args, sock=None):
+        """sock - уже подключенный socket.socket (socketpair, accept), оборачиваем как есть"""
+        self._loop = self.evloop
+        self._sock = sock if sock is not None else socket.socket(*args)
         self._sock.setblocking(False)
-        self.evloop.register_fileobj(self._sock, self._on_event)
+        self._loop.register_fileobj(self._sock, self._on_event)
 
-        self._state = self.state.INITIAL
+        if sock is None:
+            self._state = self.state.INITIAL
+        elif sock.getsockopt(socket.SOL_SOCKET, socket.SO_ACCEPTCONN):
+            # слушающий сокет, созданный заранее (например, до fork)
+            self._state = self.state.LISTENING
+        else:
+            self._state = self.state.CONNECTED
         self._callbacks = {}
+        # маска, на которую сокет сейчас подписан в селекторе
+        self._events = 0
+
+        # приемный буфер переиспользуется между чтениями: данные лежат в [_rstart, _rend)
+        self._rbuf = bytearray(RECV_BUFSIZE)
+        self._rstart = 0
+        self._rend = 0
+        # с какого места продолжать поиск разделителя в recv_until
+        self._rscan = 0
+        self._eof = False
+        # идет операция чтения (ждем сокет или уже запланирована отдача из буфера)
+        self._reading = False
+
+        # очередь на отправку: memoryview'ы без копирования, отправленная часть срезается курсором
+        self._wbuf = collections.deque()
+        # (сколько всего байт должно уйти, callback) - callback зовется, когда отправлено столько
+        self._wcallbacks = collections.deque()
+        self._wqueued = 0
+        self._wsent = 0
+        # запись запланирована через call_soon и еще не выполнена
+        self._wflush = False
+
+        # backpressure: выше high зовем pause_writing, опустились до low - resume_writing
+        self._write_high = WRITE_HIGH_WATER
+        self._write_low = WRITE_LOW_WATER
+        self._writing_paused = False
+        self._pause_writing = None
+        self._resume_writing = None
 
     def _on_event(self, mask):
         """run a callback from self._callbaks if exists"""
@@ -59,6 +127,11 @@ class _socket(Context):
                 self._state = self.state.CONNECTED
             callback(error)
 
+        if self._state == self.state.LISTENING:
+            if mask & selectors.EVENT_READ:
+                self._on_accept_ready()
+            return self._update_events(mask)
+
         if mask & selectors.EVENT_READ:
             callback = self._callbacks.get('recv')
             if callback:
@@ -73,6 +146,32 @@ class _socket(Context):
                 error = self._get_sock_error()
                 callback(error)
 
+        self._update_events(mask)
+
+    def _update_events(self, consumed=0):
+        """Подписываемся только на события, которых ждут callbacks:
+        EVENT_WRITE - пока висит conn/sent, EVENT_READ - пока висит recv или accept.
+        Простаивающий сокет почти всегда writable, так что постоянная подписка на
+        EVENT_WRITE будила бы цикл на каждой итерации впустую
+
+        consumed - маска только что обработанного события. При edge-triggered
+        бэкенде следующего события по ним не будет, пока не переподпишемся: EPOLL_CTL_MOD
+        заново проверяет готовность, поэтому если callback снова ждет того же, делаем modify"""
+        if self._state == self.state.CLOSED:
+            return
+
+        events = 0
+        if 'recv' in self._callbacks or 'accept' in self._callbacks:
+            events |= selectors.EVENT_READ
+        if 'conn' in self._callbacks or 'sent' in self._callbacks:
+            events |= selectors.EVENT_WRITE
+
+        if events != self._events:
+            self._loop.modify_fileobj(self._sock, events)
+            self._events = events
+        elif events & consumed and self._loop.edge_triggered:
+            self._loop.modify_fileobj(self._sock, events, rearm=True)
+
     def _get_sock_error(self):
         # Флаги могут существовать на нескольких уровнях протоколов; они всегда присутствуют на самом верхнем из них.
         # При манипулировании флагами сокета должен быть указан уровень, на котором находится этот флаг, и имя этого
@@ -87,84 +186,633 @@ class _socket(Context):
             return IOError('connection failed', error, errno.errorcode[error])
 
     def connect(self, addr, callback):
-        """"""
+        """addr с именем хоста (не числовым адресом) сначала резолвится в пуле потоков:
+        getaddrinfo блокирует, и цикл стоял бы на каждом DNS-запросе"""
         assert self._state == self.state.INITIAL, 'Socket state is not INITIAL'
         self._state = self.state.CONNECTING
+        if not _needs_resolve(self._sock.family, addr):
+            return self._connect(addr, callback)
+
+        def _on_resolved(error, infos=None):
+            if self._state != self.state.CONNECTING:
+                # закрыли, пока резолвили
+                return
+            if error:
+                self.close()
+                return callback(error)
+            self._connect(infos[0][4], callback)
+
+        host, port = addr[:2]
+        self._loop.run_in_executor(
+            socket.getaddrinfo, host, port, self._sock.family, socket.SOCK_STREAM, _on_resolved,
+        )
+
+    def _connect(self, addr, callback):
         self._callbacks['conn'] = callback
         err = self._sock.connect_ex(addr)
         assert errno.errorcode[err] == 'EINPROGRESS'
+        self._update_events()
+
+    def bind(self, addr, reuse_port=False):
+        """reuse_port - SO_REUSEPORT: несколько процессов слушают один порт, ядро раскидывает
+        между ними входящие соединения"""
+        # перезапущенный сервер не должен ждать, пока старые соединения выйдут из TIME_WAIT
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self._sock.bind(addr)
+
+    def getsockname(self):
+        return self._sock.getsockname()
+
+    def listen(self, backlog=socket.SOMAXCONN):
+        assert self._state == self.state.INITIAL, 'Socket state is not INITIAL'
+        self._sock.listen(backlog)
+        self._state = self.state.LISTENING
+
+    def accept(self, callback):
+        """callback(error, sock, addr) на каждое входящее соединение, пока сокет не закрыт;
+        sock - подключенный _socket"""
+        assert self._state == self.state.LISTENING, 'Socket state is not LISTENING'
+        self._callbacks['accept'] = callback
+        self._update_events()
+
+    def _on_accept_ready(self):
+        callback = self._callbacks.get('accept')
+        if not callback:
+            return
+        # разбираем очередь соединений пачкой, но не до дна: остальные callbacks тоже ждут
+        for _ in range(ACCEPT_BATCH):
+            try:
+                sock, addr = self._sock.accept()
+            except BlockingIOError:
+                return
+            except OSError as error:
+                # EMFILE, ENFILE, ECONNABORTED... - сообщаем и ждем следующего события
+                return callback(error)
+            callback(None, _socket(sock=sock), addr)
+            if self._state != self.state.LISTENING:
+                return
 
     def recv(self, n, callback):
-        """"""
+        """callback(error, data) - до n байт, пустые данные означают EOF
+
+        Здесь и в recv_exactly/recv_until data - memoryview на приемный буфер сокета, без копирования.
+        Он действителен до следующего чтения из этого сокета: нужно дольше - копировать (bytes(data))
+        """
+        def want():
+            if self._rend > self._rstart or self._eof:
+                return min(self._rend, self._rstart + n)
+            return -1
+
+        self._read(want, callback)
+
+    def recv_exactly(self, n, callback):
+        """callback(error, data) - ровно n байт"""
+        def want():
+            return self._rstart + n if self._rend - self._rstart >= n else -1
+
+        self._read(want, callback)
+
+    def recv_until(self, delimiter, callback, limit=None):
+        """callback(error, data) - данные до delimiter включительно.
+        limit - максимальная длина сообщения в байтах без delimiter; длиннее - IOError('message too long'),
+        и данные остаются в буфере (дочитать до разделителя - skip_until)"""
+        def want():
+            end = self._rbuf.find(delimiter, max(self._rstart, self._rscan), self._rend)
+            if end >= 0:
+                # сообщение целиком пришло одним куском - проверяем и его
+                if limit is not None and end - self._rstart > limit:
+                    raise IOError('message too long', limit)
+                return end + len(delimiter)
+            # хвост короче разделителя мог оказаться его началом
+            self._rscan = max(self._rstart, self._rend - len(delimiter) + 1)
+            if limit is not None and self._rend - self._rstart > limit:
+                raise IOError('message too long', limit)
+            return -1
+
+        self._read(want, callback)
+
+    def skip_until(self, delimiter, callback):
+        """callback(error) - выброшены данные до delimiter включительно (например, хвост
+        сообщения, не прошедшего limit в recv_until). Буфер при этом не растет"""
+        def want():
+            end = self._rbuf.find(delimiter, self._rstart, self._rend)
+            if end >= 0:
+                return end + len(delimiter)
+            # выбрасываем все, кроме хвоста, который может оказаться началом разделителя
+            self._rstart = max(self._rstart, self._rend - len(delimiter) + 1)
+            return -1
+
+        self._read(want, lambda error, data=None: callback(error))
+
+    def _read(self, want, callback):
+        """want() -> конец готового сообщения в буфере или -1, если данных пока не хватает"""
         assert self._state == self.state.CONNECTED
-        assert 'recv' not in self._callbacks
+        assert not self._reading
+        self._reading = True
 
         def _on_read_ready(err):
             if err:
+                self._reading = False
                 return callback(err)
-            data = self._sock.recv(n)
-            callback(None, data)
+            try:
+                self._fill()
+            except BlockingIOError:
+                pass
+            except OSError as error:
+                self._reading = False
+                return callback(error)
+            if not self._deliver(want, callback):
+                self._callbacks['recv'] = _on_read_ready
+
+        if self._rend > self._rstart or self._eof:
+            # в буфере уже что-то есть: события от сокета может больше и не быть, проверяем на следующей итерации
+            self._loop.call_soon(self._deliver_buffered, want, callback, _on_read_ready)
+        else:
+            self._callbacks['recv'] = _on_read_ready
+            self._update_events()
+
+    def _deliver_buffered(self, want, callback, on_read_ready):
+        if self._state == self.state.CLOSED:
+            return
+        if not self._deliver(want, callback):
+            self._callbacks['recv'] = on_read_ready
+            self._update_events()
 
-        self._callbacks['on_read_ready'] = _on_read_ready
+    def _deliver(self, want, callback):
+        """Отдает callback'у готовое сообщение; False - надо ждать еще данных"""
+        try:
+            end = want()
+        except IOError as error:
+            self._reading = False
+            callback(error)
+            return True
+
+        if end < 0:
+            if not self._eof:
+                return False
+            self._reading = False
+            callback(IOError('connection closed', self._rend - self._rstart))
+            return True
+
+        data = memoryview(self._rbuf)[self._rstart:end]
+        self._rstart = end
+        self._rscan = 0
+        if self._rstart == self._rend:
+            self._rstart = self._rend = 0
+        self._reading = False
+        callback(None, data)
+        return True
+
+    def _fill(self):
+        """Один recv_into в свободный хвост буфера"""
+        if self._rend == len(self._rbuf):
+            size = self._rend - self._rstart
+            if self._rstart:
+                # сдвигаем непрочитанное в начало; выданные ранее memoryview при этом портятся
+                self._rbuf[:size] = self._rbuf[self._rstart:self._rend]
+                self._rscan -= self._rstart
+            else:
+                # расширяем новым буфером: bytearray с живыми memoryview менять размер не может
+                rbuf = bytearray(len(self._rbuf) * 2)
+                rbuf[:size] = self._rbuf
+                self._rbuf = rbuf
+            self._rstart, self._rend = 0, size
+
+        n = self._sock.recv_into(memoryview(self._rbuf)[self._rend:])
+        if not n:
+            self._eof = True
+        self._rend += n
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        """Водяные знаки буфера записи в байтах; не заданный low - четверть high"""
+        if high is None:
+            high = WRITE_HIGH_WATER if low is None else 4 * low
+        if low is None:
+            low = high // 4
+        assert high >= low >= 0, f'high ({high}) must be >= low ({low}) must be >= 0'
+        self._write_high = high
+        self._write_low = low
+        self._maybe_pause_writing()
+
+    def set_flow_control(self, pause_writing, resume_writing):
+        """pause_writing() - буфер записи перевалил за high, производителю пора остановиться,
+        resume_writing() - буфер опустел до low, можно писать дальше"""
+        self._pause_writing = pause_writing
+        self._resume_writing = resume_writing
+
+    def get_write_buffer_size(self):
+        return self._wqueued - self._wsent
+
+    def get_read_buffer_size(self):
+        """Сколько прочитанных из сокета байт еще не отдано callbacks"""
+        return self._rend - self._rstart
+
+    def is_writing_paused(self):
+        return self._writing_paused
+
+    def _maybe_pause_writing(self):
+        if not self._writing_paused and self.get_write_buffer_size() > self._write_high:
+            self._writing_paused = True
+            if self._pause_writing:
+                self._pause_writing()
+
+    def _maybe_resume_writing(self):
+        if self._writing_paused and self.get_write_buffer_size() <= self._write_low:
+            self._writing_paused = False
+            if self._resume_writing:
+                self._resume_writing()
 
     def sendall(self, data, callback):
+        """data - bytes-like или список bytes-like (уйдут одним sendmsg, как writev).
+        Данные не копируются: менять переданные буферы до callback нельзя.
+        Пока предыдущие записи в полете, новые встают в очередь; ее рост ограничивают
+        водяные знаки (set_write_buffer_limits, set_flow_control).
+
+        Первая запись после простоя пишется в конце итерации (call_soon), так что все sendall
+        за одну итерацию цикла уходят одним системным вызовом. Простаивающий сокет почти
+        всегда writable, поэтому EVENT_WRITE не ждем: подписываемся, только если сокет
+        принял не все"""
         assert self._state == self.state.CONNECTED
-        assert 'sent' not in self._callbacks
 
-        def _on_write_ready(err):
-            nonlocal data
-            if err:
-                return callback(err)
+        buffers = data if isinstance(data, (list, tuple)) else (data,)
+        for buf in buffers:
+            view = memoryview(buf).cast('B')
+            if view.nbytes:
+                self._wbuf.append(view)
+                self._wqueued += view.nbytes
+        self._wcallbacks.append((self._wqueued, callback))
+
+        if not self._wflush and 'sent' not in self._callbacks:
+            self._wflush = True
+            self._loop.call_soon(self._flush)
+        self._maybe_pause_writing()
+
+    def _flush(self):
+        self._wflush = False
+        if self._state == self.state.CONNECTED:
+            self._on_write_ready(None)
+            self._update_events()
+
+    def _on_write_ready(self, err):
+        if err:
+            return self._fail_writes(err)
+
+        if self._wbuf:
+            try:
+                n = self._sock.sendmsg(list(itertools.islice(self._wbuf, IOV_MAX)))
+            except BlockingIOError:
+                n = 0
+            except OSError as error:
+                return self._fail_writes(error)
+            self._advance_wbuf(n)
+            self._maybe_resume_writing()
 
-            n = self._sock.send(data)
-            if n < len(data):
-                data = data[n:]
-                self._callbacks['sent'] = _on_write_ready
+        while self._wcallbacks and self._wcallbacks[0][0] <= self._wsent:
+            _, callback = self._wcallbacks.popleft()
+            callback(None)
+
+        # sendall из callbacks выше мог уже запланировать запись - тогда ждать сокет незачем
+        if self._wbuf and self._state == self.state.CONNECTED and not self._wflush:
+            self._callbacks['sent'] = self._on_write_ready
+
+    def _advance_wbuf(self, n):
+        """Сдвигает курсор на n отправленных байт: целые буферы выкидываем, частичный срезаем"""
+        self._wsent += n
+        while n:
+            view = self._wbuf[0]
+            if n >= view.nbytes:
+                self._wbuf.popleft()
+                n -= view.nbytes
             else:
-                callback(None)
+                self._wbuf[0] = view[n:]
+                n = 0
+
+    def _fail_writes(self, error):
+        self._wbuf.clear()
+        self._wsent = self._wqueued
+        callbacks = self._wcallbacks
+        self._wcallbacks = collections.deque()
+        for _, callback in callbacks:
+            callback(error)
+
+    def is_alive(self):
+        """Проверка простаивающего соединения: не закрыто ли оно с той стороны
+        и не пришло ли в него что-то без запроса"""
+        if self._state != self.state.CONNECTED or self._rend > self._rstart or self._eof:
+            return False
+        try:
+            # b'' - EOF, данные без запроса - тоже плохой знак
+            self._sock.recv(1, socket.MSG_PEEK)
+            return False
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
 
-        self._callbacks['sent'] = _on_write_ready
+    def detach(self):
+        """Отвязывает socket.socket от цикла, не закрывая: например, чтобы передать
+        принятое соединение циклу другого потока. Буфер чтения должен быть пуст"""
+        assert self._rend == self._rstart and not self._wbuf, 'Socket has buffered data'
+        sock = self._sock
+        self._loop.unregister_fileobj(sock)
+        self._callbacks.clear()
+        self._state = self.state.CLOSED
+        return sock
 
     def close(self):
-        self.evloop.unregister_fileobj(self._sock)
+        self._loop.unregister_fileobj(self._sock)
         self._callbacks.clear()
+        self._reading = False
+        self._wbuf.clear()
+        self._wcallbacks.clear()
         self._state = self.state.CLOSED
         self._sock.close()
 
 
+def _needs_resolve(family, addr):
+    if family not in (socket.AF_INET, socket.AF_INET6):
+        return False
+    try:
+        socket.inet_pton(family, addr[0])
+    except OSError:
+        return True
+    return False
+
+
 class set_timer(Context):
     """Convenience method to call event_loop.set_timer() without knowing about
      the current event loop variable
      регистрирует callback с задержкой в event loop
 
-     duration - in ms
+     duration - в тиках hrtime(), т.е. в наносекундах (см. consts.MS, consts.SEC)
+
+     Экземпляр служит хендлом: set_timer(...).cancel() отменяет таймер
      """
     def __init__(self, duration, callback):
-        self.evloop.set_timer(duration, callback)
+        self._loop = self.evloop
+        self._handle = self._loop.set_timer(duration, callback)
 
+    def cancel(self):
+        self._handle.cancel()
 
-class EventLoop:
+    def cancelled(self):
+        return self._handle.cancelled()
+
+
+class Future(Context):
+    """Результат, который появится позже: await future приостанавливает задачу
+    до set_result/set_exception
+
+    В отличие от asyncio, done callbacks вызываются сразу, а не через call_soon: задача
+    продолжается в том же callback'е _socket, который завершил операцию - без лишней итерации
+    цикла, и memoryview из recv еще действителен (до следующего чтения из сокета)"""
     def __init__(self):
-        self._queue = Queue()
+        self._done = False
+        self._result = None
+        self._exception = None
+        # исключение кто-то получил: задача, которую не дождались, сообщит о нем сама
+        self._retrieved = False
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    def result(self):
+        if not self._done:
+            raise RuntimeError('result is not ready')
+        self._retrieved = True
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self):
+        if not self._done:
+            raise RuntimeError('result is not ready')
+        self._retrieved = True
+        return self._exception
+
+    def add_done_callback(self, callback):
+        """callback(future); у готового future вызывается сразу"""
+        if self._done:
+            callback(self)
+        else:
+            self._callbacks.append(callback)
+
+    def set_result(self, result):
+        self._set(result, None)
+
+    def set_exception(self, exception):
+        self._set(None, exception)
+
+    def _set(self, result, exception):
+        if self._done:
+            raise RuntimeError('future is already done')
+        self._done = True
+        self._result = result
+        self._exception = exception
+        callbacks, self._callbacks = self._callbacks, None
+        for callback in callbacks:
+            callback(self)
+
+    def _complete(self, error, result=None):
+        """callback(error[, result]) в стиле _socket и Client"""
+        if error:
+            self.set_exception(error)
+        else:
+            self.set_result(result)
+
+    def __await__(self):
+        if not self._done:
+            yield self
+        return self.result()
+
+
+class Task(Future):
+    """Выполняет сопрограмму: шаг до await незавершенного future, следующий шаг - когда он
+    завершится. Результат сопрограммы - результат задачи, задачу можно ждать как future"""
+    def __init__(self, coro):
+        super().__init__()
+        self._coro = coro
+        # один bound method на задачу, а не на каждый await
+        self._wakeup = self._step
+        self._loop = self.evloop
+        self._loop.call_soon(self._step, None)
+
+    def _step(self, future):
+        result, error = (None, None) if future is None else (future._result, future._exception)
+        if future is not None and error is not None:
+            future._retrieved = True
+        # готовые future не отдаем циклу: продолжаем, пока сопрограмма не встанет по-настоящему
+        while True:
+            try:
+                if error is None:
+                    yielded = self._coro.send(result)
+                else:
+                    yielded = self._coro.throw(error)
+            except StopIteration as stop:
+                return self.set_result(stop.value)
+            except Exception as exc:
+                return self.set_exception(exc)
+
+            if not isinstance(yielded, Future):
+                result, error = None, RuntimeError(f'task got bad yield: {yielded!r}')
+            elif not yielded._done:
+                yielded._callbacks.append(self._wakeup)
+                return
+            else:
+                result, error = yielded._result, yielded._exception
+
+    def __del__(self):
+        if self._exception is not None and not self._retrieved:
+            # исключение задачи, которую никто не дождался, иначе потерялось бы молча
+            print('Uncaught exception in task:', repr(self._exception))
+
+
+def from_callback(func, *args):
+    """Future для операции в стиле func(*args, callback(error[, result])):
+
+        sock = await from_callback(pool.acquire)"""
+    future = Future()
+    func(*args, future._complete)
+    return future
+
+
+def sleep(duration, result=None):
+    """await sleep(duration) - duration в тиках hrtime(), как у set_timer"""
+    future = Future()
+    future.evloop.set_timer(duration, functools.partial(future.set_result, result))
+    return future
+
+
+def gather(*aws):
+    """Future со списком результатов aws (future или сопрограмм) в их порядке. Первое
+    исключение завершает gather, остальные задачи при этом продолжают работать"""
+    outer = Future()
+    futures = [aw if isinstance(aw, Future) else Task(aw) for aw in aws]
+    pending = len(futures)
+    if not pending:
+        outer.set_result([])
+        return outer
+
+    def on_done(future):
+        nonlocal pending
+        if outer._done:
+            return
+        if future._exception is not None:
+            future._retrieved = True
+            return outer.set_exception(future._exception)
+        pending -= 1
+        if not pending:
+            outer.set_result([future._result for future in futures])
+
+    for future in futures:
+        future.add_done_callback(on_done)
+    return outer
+
+
+# awaitable операции _socket; data из recv* - memoryview, как и в callback'ах:
+# действителен до следующего чтения из сокета
+
+def sock_connect(sock, addr):
+    return from_callback(sock.connect, addr)
+
+
+def sock_sendall(sock, data):
+    return from_callback(sock.sendall, data)
+
+
+def sock_recv(sock, n):
+    return from_callback(sock.recv, n)
+
+
+def sock_recv_exactly(sock, n):
+    return from_callback(sock.recv_exactly, n)
+
+
+def sock_recv_until(sock, delimiter, limit=None):
+    future = Future()
+    sock.recv_until(delimiter, future._complete, limit)
+    return future
+
+
+class EventLoop:
+    def __init__(self, poller=None, executor=None):
+        """poller - бэкенд мультиплексора из pollers.py, по умолчанию SelectorPoller
+        executor - concurrent.futures.Executor для run_in_executor, по умолчанию
+        ThreadPoolExecutor, который создается при первом вызове и закрывается в конце run"""
+        self._queue = Queue(poller)
         self._time = None
+        # signum -> callback; сами сигналы приходят байтами в wakeup fd
+        self._signal_handlers = {}
+        self._signal_rsock = None
+        self._signal_wsock = None
+        self._executor = executor
+        self._own_executor = False
+        # задачи в пуле держат цикл, как таймеры
+        self._jobs = 0
+        # (callback, args) из других потоков; deque.append/popleft атомарны, блокировка не нужна
+        self._incoming = collections.deque()
+        # waker уже взведен и еще не сброшен циклом - будить повторно незачем
+        self._woken = False
+        # служебный fd: сам по себе цикл не держит
+        self._waker = _Waker()
+        self._queue.register_fileobj(
+            self._waker.fileno(), self._on_wakeup, selectors.EVENT_READ, daemon=True,
+        )
+
+    @property
+    def edge_triggered(self):
+        return self._queue.edge_triggered
 
     def run(self, entry_point, *args):
-        self._execute(entry_point, *args)
+        """entry_point(*args) - функция или async def; сопрограмма запускается задачей,
+        и run возвращает ее результат"""
+        self._time = hrtime()
+        # цикл, который запускают в потоке, - текущий для этого потока
+        Context.set_event_loop(self)
+        task = None
+        if inspect.iscoroutinefunction(entry_point):
+            task = self.create_task(entry_point(*args))
+        else:
+            self._execute(entry_point, *args)
 
-        while not self._queue.is_empty():
-            fn, mask = self._queue.pop(self._time)  # откуда берется self._time?
-            self._execute(fn, mask)
+        # задачу ждем, даже если цикл пуст: ее может разбудить другой поток через call_soon_threadsafe
+        while self._jobs or not self._queue.is_empty() or (task is not None and not task.done()):
+            self._run_once()
 
+        self._close_signals()
+        self._close_executor()
+        self._queue.unregister_fileobj(self._waker.fileno())
+        self._waker.close()
         self._queue.close()
+        if task is not None:
+            return task.result()
 
-    def _execute(self, callback, *args):
+    def create_task(self, coro):
+        return Task(coro)
+
+    def _run_once(self):
+        """Одна итерация цикла, как _run_once в asyncio и uv_run в libuv:
+        один опрос селектора переносит в очередь все готовые события и истекшие таймеры,
+        затем прогоняем снимок очереди. То, что callbacks добавят по ходу, уйдет на следующую итерацию"""
+        # таймаут считаем от свежего времени: предыдущие callbacks могли работать долго
+        self._time = hrtime()
+        ready = self._queue.poll(self._time)
+        # таймеры сверяем с реальными часами после ожидания; дальше callbacks видят закешированное время
         self._time = hrtime()
+        self._queue.expire_timers(self._time)
+        for _ in range(len(ready)):
+            fn, args = ready.popleft()
+            self._execute(fn, *args)
+
+    def _execute(self, callback, *args):
         try:
             # "корень" стека
             callback(*args)
         except Exception as err:
             print('Uncaught exception:', err)
-        self._time = hrtime()
 
     def register_fileobj(self, fileobj, callback):
         """а нужно ли?"""
@@ -174,40 +822,210 @@ class EventLoop:
         """а нужно ли?"""
         self._queue.unregister_fileobj(fileobj)
 
+    def modify_fileobj(self, fileobj, events, rearm=False):
+        self._queue.modify_fileobj(fileobj, events, rearm)
+
+    def add_signal_handler(self, signum, callback):
+        """callback() на итерации цикла после прихода сигнала signum
+
+        Python-обработчик сигнала ничего не делает, а интерпретатор пишет номер сигнала
+        в wakeup fd (signal.set_wakeup_fd): цикл читает его как обычный сокет, и callback
+        не врезается посреди другого callback'а. Только из главного потока"""
+        if self._signal_rsock is None:
+            self._signal_rsock, self._signal_wsock = socket.socketpair()
+            self._signal_rsock.setblocking(False)
+            self._signal_wsock.setblocking(False)
+            signal.set_wakeup_fd(self._signal_wsock.fileno())
+            # служебный сокет: ждать сигналов ради них самих цикл не должен
+            self._queue.register_fileobj(
+                self._signal_rsock, self._on_signal, selectors.EVENT_READ, daemon=True,
+            )
+        self._signal_handlers[signum] = callback
+        signal.signal(signum, _noop_signal_handler)
+
+    def _on_signal(self, mask):
+        while True:
+            try:
+                data = self._signal_rsock.recv(KB)
+            except BlockingIOError:
+                return
+            for signum in data:
+                callback = self._signal_handlers.get(signum)
+                if callback:
+                    self.call_soon(callback)
+
+    def _close_signals(self):
+        if self._signal_rsock is None:
+            return
+        for signum in self._signal_handlers:
+            signal.signal(signum, signal.SIG_DFL)
+        self._signal_handlers.clear()
+        signal.set_wakeup_fd(-1)
+        self._queue.unregister_fileobj(self._signal_rsock)
+        self._signal_rsock.close()
+        self._signal_wsock.close()
+        self._signal_rsock = self._signal_wsock = None
+
+    def set_default_executor(self, executor):
+        self._close_executor()
+        self._executor = executor
+
+    def run_in_executor(self, fn, *args):
+        """fn(*args) в пуле; последний аргумент - callback(error, result), он зовется в цикле.
+        Для блокирующей работы: разбор большого json, DNS, чтение файлов.
+
+            data = await from_callback(loop.run_in_executor, json.loads, body)
+
+        Пул сообщает о готовности через waker (eventfd или self-pipe) в селекторе - одно
+        пробуждение на пачку готовых результатов, без опроса. Для ProcessPoolExecutor fn,
+        аргументы и результат должны pickle'иться"""
+        *args, callback = args
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(thread_name_prefix='evloop')
+            self._own_executor = True
+        future = self._executor.submit(fn, *args)
+        self._jobs += 1
+        # поток пула (или служебный поток ProcessPoolExecutor) зовет это через call_soon_threadsafe
+        future.add_done_callback(functools.partial(self.call_soon_threadsafe, self._job_done, callback))
+
+    def _job_done(self, callback, future):
+        self._jobs -= 1
+        error = future.exception()
+        if error:
+            return callback(error)
+        callback(None, future.result())
+
+    def _close_executor(self):
+        if self._own_executor:
+            self._executor.shutdown()
+            self._executor = None
+            self._own_executor = False
+
+    def call_soon_threadsafe(self, callback, *args):
+        """call_soon из любого потока: callback(*args) выполнится в потоке цикла, даже если
+        тот спит в select без таймаута. Сам вызов цикл не держит: run(func) завершится, если
+        ждать больше нечего, run(async def) ждет свою задачу, пока ее не разбудят
+
+        Запись в waker - только если он еще не взведен: пачка вызовов, пришедшая, пока цикл
+        занят или спит, стоит одного системного вызова и одного пробуждения"""
+        self._incoming.append((callback, args))
+        if not self._woken:
+            self._woken = True
+            self._waker.wake()
+
+    def _on_wakeup(self, mask):
+        # сначала waker, потом флаг, потом deque. Наоборот clear мог бы съесть запись producer'а,
+        # взведшего флаг после сброса, - флаг остался бы взведен, и цикл больше не проснулся бы.
+        # Так вызов, добавленный после сброса флага, снова разбудит цикл; лишнее пробуждение безвредно
+        self._waker.clear()
+        self._woken = False
+        for _ in range(len(self._incoming)):
+            callback, args = self._incoming.popleft()
+            self._execute(callback, *args)
+
+    def call_soon(self, callback, *args):
+        """Запустить callback на следующей итерации цикла. Только из потока цикла,
+        из других - call_soon_threadsafe"""
+        self._queue.push(callback, args)
+
+    def time(self):
+        """Время начала текущей итерации цикла в тиках hrtime()"""
+        return self._time if self._time is not None else hrtime()
+
     def set_timer(self, duration, callback):
-        self._time = hrtime()
-        # на данный момент lambda излишня
-        self._queue.register_timer(self._time + duration, callback)
+        """Возвращает TimerHandle, у которого можно вызвать cancel()
+
+        Срок отсчитывается от закешированного времени итерации, как в libuv"""
+        return self._queue.register_timer(self.time() + duration, callback)
+
+
+def _noop_signal_handler(signum, frame):
+    pass
+
+
+class _Waker:
+    """Будильник цикла из других потоков (call_soon_threadsafe): eventfd, где он есть (linux), иначе self-pipe.
+    Записи eventfd складываются в один счетчик - сколько бы потоков ни будили цикл,
+    select вернет одно событие, и clear прочитает его одним вызовом"""
+    def __init__(self, use_eventfd=hasattr(os, 'eventfd')):
+        if use_eventfd:
+            self._rfd = self._wfd = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+        else:
+            self._rfd, self._wfd = os.pipe()
+            os.set_blocking(self._rfd, False)
+            os.set_blocking(self._wfd, False)
+
+    def fileno(self):
+        return self._rfd
+
+    def wake(self):
+        try:
+            if self._rfd == self._wfd:
+                os.eventfd_write(self._wfd, 1)
+            else:
+                os.write(self._wfd, b'\0')
+        except BlockingIOError:
+            # pipe полон - цикл и так проснется
+            pass
+
+    def clear(self):
+        try:
+            if self._rfd == self._wfd:
+                os.eventfd_read(self._rfd)
+            else:
+                while os.read(self._rfd, KB):
+                    pass
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        os.close(self._rfd)
+        if self._wfd != self._rfd:
+            os.close(self._wfd)
 
 
 def hrtime():
-    """return time in ms"""
-    # походу 10e6 - разрешение таймера
-    return int(time.time() * 10e6)
+    """Монотонное время в наносекундах - единый тик для таймеров и таймаутов цикла.
+    Не зависит от перевода системных часов (NTP и т.п.)"""
+    return time.monotonic_ns()
+
+
+# ширина слота колеса таймеров
+TIMER_RESOLUTION = MS
 
 
 class Queue:
     """Фасад для двух суб-очередей"""
-    def __init__(self):
+    def __init__(self, poller=None):
         # мультиплексирование i/o
-        self._selector = selectors.DefaultSelector()
-        self._timers = []
-        self._timer_no = 0
+        self._poller = poller if poller is not None else SelectorPoller()
+        self.edge_triggered = self._poller.edge_triggered
+        # fileobj -> [callback, events]; в poller лежат только объекты с непустой маской
+        self._fileobjs = {}
+        # колесо вместо heapq: таймауты запросов почти всегда отменяются до срабатывания
+        self._timers = TimerWheel(hrtime(), TIMER_RESOLUTION)
+        # (callback, args)
         self._ready = collections.deque()
+        # служебные fileobj (wakeup fd и т.п.): лежат в poller, но цикл не держат
+        self._daemons = set()
 
     def is_empty(self):
-        # Возвращает сопоставление файловых объектов с ключами селектора.
-        return not (self._ready or self._timers or self._selector.get_map())
+        # Сокет без ожидающих операций в poller не лежит и цикл не держит
+        if self._ready or self._timers:
+            return False
+        daemons = sum(1 for fileobj in self._daemons if self._fileobjs[fileobj][1])
+        return len(self._poller) <= daemons
 
     def get_timeout(self, tick):
-        return (self._timers[0][0] - tick) / 10e6 if self._timers else None
+        deadline = self._timers.next_expiry()
+        return max(deadline - tick, 0) / SEC if deadline is not None else None
 
-    def pop(self, tick):
-        """Возвращает следующий готовый к выполению callback
-        Если нечего запускать - просто спит
+    def poll(self, tick):
+        """Переносит в очередь готовых события i/o, возвращает очередь готовых (callback, args).
+        Если нечего запускать - спит в select до ближайшего таймера (таймеры забирает expire_timers)
 
-        На каждой итерации цикл событий пытается синхронно извлечь следующий обратный вызов из очереди. Если в данный
-        момент нет обратного вызова для выполнения, pop() блокирует основной поток. Когда обратный вызов готов, цикл
+        На каждой итерации цикл событий синхронно забирает из очереди все готовые обратные вызовы. Если в данный
+        момент нет обратного вызова для выполнения, poll() блокирует основной поток. Когда обратный вызов готов, цикл
         обработки событий выполняет его. Выполнение обратного вызова всегда происходит синхронно. Каждое выполнение
         обратного вызова запускает новый стек вызовов, который длится до полного синхронного вызова в дереве вызовов с
         корнем в исходном обратном вызове. Это также объясняет, почему ошибки должны доставляться как параметры
@@ -218,56 +1036,69 @@ class Queue:
 
         Выполнение текущего обратного вызова регистрирует новые обратные вызовы в очереди. И цикл повторяется.
         """
-        if self._ready:
-            return self._ready.popleft()
-
-        timeout = self.get_timeout(tick)
+        # уже есть что запускать - только подбираем готовые события, не блокируясь.
+        # Иначе ждем i/o, но не дольше срока ближайшего таймера: один системный вызов на простой
+        timeout = 0 if self._ready else self.get_timeout(tick)
 
         # при операциях на зареганых сокетах - возникает event соответствующей
         # маской и данными
-        events = self.select(timeout)
-        for key, mask in events:
-            callback = key.data
-            self._ready.append((callback,  mask))
-
-        if not self._ready and self._timers:
-            idle = (self._timers[0][0] - tick)
-            if idle > 0:
-                time.sleep(idle / 10e6)
-                return self.pop(tick + idle)
-
-        while self._timers and self._timers[0][0] <= tick:
-            _, _, callback = heapq.heappop(self._timers)
-            self._ready.append((callback, None))
-
-        return self._ready.popleft()
+        for callback, mask in self.select(timeout):
+            self._ready.append((callback, (mask,)))
+
+        return self._ready
+
+    def push(self, callback, args):
+        self._ready.append((callback, args))
+
+    def expire_timers(self, tick):
+        """Переносит в очередь готовых таймеры со сроком <= tick"""
+        for handle in self._timers.expire(tick):
+            self._ready.append((handle._run, ()))
+
     def select(self, timeout):
-        try:
-            events = self._selector.select(timeout)
-        except OSError:
-            time.sleep(timeout)
-            events = []
-        return events
+        """[(callback, mask)] готовых объектов"""
+        return self._poller.poll(timeout)
+
     def register_timer(self, tick, callback):
-        timer = (tick, self._timer_no, callback)
-        heapq.heappush(self._timers, timer)
-        self._timer_no += 1
+        return self._timers.add(tick, callback)
+
+    def register_fileobj(self, fileobj, callback, events=0, daemon=False):
+        """Запоминает callback для fileobj; в селектор объект попадает только когда
+        у него появляется непустая маска событий (см. modify_fileobj).
+        daemon - служебный объект, ожидание на нем одном не держит цикл"""
+        self._fileobjs[fileobj] = [callback, 0]
+        if daemon:
+            self._daemons.add(fileobj)
+        if events:
+            self.modify_fileobj(fileobj, events)
+
+    def modify_fileobj(self, fileobj, events, rearm=False):
+        """rearm - повторить modify с той же маской (переподписка для edge-triggered)"""
+        entry = self._fileobjs[fileobj]
+        callback, current = entry
+        if events == current and not (rearm and events):
+            return
 
-    def register_fileobj(self, fileobj, callback):
-        events = selectors.EVENT_READ | selectors.EVENT_WRITE
         # Зарегистрировать файловый объект для выбора, отслеживая его на предмет событий ввода-вывода.
         # fileobj — это файловый объект, который нужно отслеживать. Это может быть целочисленный файловый дескриптор или объект с методом fileno(). events — это побитовая маска отслеживаемых событий. data — непрозрачный объект.
         # Это возвращает новый экземпляр SelectorKey или вызывает ValueError в случае недопустимой маски события или дескриптора файла, или KeyError, если объект файла уже зарегистрирован
-        self._selector.register(fileobj, events, callback)
+        if not current:
+            self._poller.register(fileobj, events, callback)
+        elif not events:
+            self._poller.unregister(fileobj)
+        else:
+            self._poller.modify(fileobj, events, callback)
+        entry[1] = events
 
     def unregister_fileobj(self, fileobj):
         # Это возвращает связанный экземпляр SelectorKey или вызывает KeyError, если fileobj не зарегистрирован.
-        self._selector.unregister(fileobj)
-
-    # def select(self):
+        _, events = self._fileobjs.pop(fileobj)
+        self._daemons.discard(fileobj)
+        if events:
+            self._poller.unregister(fileobj)
 
     def close(self):
-        self._selector.close()
+        self._poller.close()
 
 
 # def main():
@@ -0,0 +1,132 @@
+"""Несколько EventLoop в одном процессе: цикл на поток и раздача работы между циклами
+
+    loops = LoopGroup(4, LEAST_LOADED, setup=lambda: Client(addr), teardown=Client.close)
+    loops.start()
+    loops.dispatch(Client.get_user, user_id, callback)  # client.get_user(user_id, callback) на одном из циклов
+    loops.stop()
+
+Объекты Context (сокеты, таймеры, Client) живут на цикле потока, в котором созданы, поэтому
+состояние цикла (пул соединений и т.п.) создает setup в его же потоке.
+
+Потоки делят GIL: Python-код циклов выполняется по очереди, параллельно идут только
+системные вызовы и то, что отпускает GIL. Цикл на ядро - процессы (prefork в server.py).
+"""
+import itertools
+import operator
+import threading
+
+from event_loop import EventLoop, Future
+
+ROUND_ROBIN = 'round-robin'
+LEAST_LOADED = 'least-loaded'
+POLICIES = (ROUND_ROBIN, LEAST_LOADED)
+
+
+class LoopThread:
+    """EventLoop в своем потоке; state - результат setup() в этом потоке"""
+    def __init__(self, index, setup=None, teardown=None):
+        self.index = index
+        self.loop = EventLoop()
+        self.state = None
+        # load = submitted - completed; submitted меняется под блокировкой LoopGroup,
+        # completed - только в потоке цикла
+        self.submitted = 0
+        self.completed = 0
+        self._setup = setup
+        self._teardown = teardown
+        self._started = threading.Event()
+        # исключение setup(), start() поднимет его в вызвавшем потоке
+        self._error = None
+        # цикл ждет stop(): setup прошел, _stopped еще не выставлен
+        self._running = False
+        self._stopped = None
+        # daemon: процесс может выйти, не дожидаясь stop()
+        self._thread = threading.Thread(
+            target=self.loop.run, args=(self._main,), name=f'loop-{index}', daemon=True,
+        )
+
+    @property
+    def load(self):
+        """Сколько переданной циклу работы еще не закончено"""
+        return self.submitted - self.completed
+
+    def start(self):
+        self._thread.start()
+        self._started.wait()
+        if self._error is not None:
+            self._thread.join()
+            raise self._error
+
+    def stop(self):
+        """Цикл доделает начатое и завершится"""
+        # после выхода цикла waker закрыт - будить уже некого
+        if self._running:
+            self._running = False
+            self.loop.call_soon_threadsafe(self._stopped.set_result, None)
+        if self._thread.ident is not None:
+            self._thread.join()
+
+    async def _main(self):
+        self._stopped = Future()
+        try:
+            if self._setup is not None:
+                self.state = self._setup()
+            self._running = True
+        except Exception as error:
+            self._error = error
+            return
+        finally:
+            self._started.set()
+        await self._stopped
+        if self._teardown is not None:
+            self._teardown(self.state)
+
+    def _run(self, fn, args, callback):
+        def done(*result):
+            self.completed += 1
+            callback(*result)
+
+        try:
+            fn(self.state, *args, done)
+        except Exception as error:
+            done(error)
+
+
+class LoopGroup:
+    """loops циклов в потоках и раздача работы между ними по policy:
+    ROUND_ROBIN - по кругу, LEAST_LOADED - циклу с наименьшей незаконченной работой"""
+    def __init__(self, loops, policy=ROUND_ROBIN, setup=None, teardown=None):
+        if policy not in POLICIES:
+            raise ValueError(f'unknown policy {policy!r}')
+        self.policy = policy
+        self.workers = [LoopThread(index, setup, teardown) for index in range(loops)]
+        self._round_robin = itertools.cycle(self.workers)
+        # выбор цикла и submitted - под одной блокировкой: dispatch зовут из любых потоков,
+        # в том числе из самих циклов
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Если setup() упал в каком-то цикле, уже запущенные останавливаются, а ошибка поднимается"""
+        try:
+            for worker in self.workers:
+                worker.start()
+        except Exception:
+            self.stop()
+            raise
+
+    def stop(self):
+        for worker in self.workers:
+            worker.stop()
+
+    def dispatch(self, fn, *args):
+        """fn(state, *args, callback) на выбранном цикле; последний аргумент - callback(error[, result]),
+        он зовется в потоке этого цикла. Возвращает LoopThread, которому досталась работа"""
+        *args, callback = args
+        with self._lock:
+            if self.policy == ROUND_ROBIN:
+                worker = next(self._round_robin)
+            else:
+                worker = min(self.workers, key=operator.attrgetter('load'))
+            worker.submitted += 1
+        worker.loop.call_soon_threadsafe(worker._run, fn, args, callback)
+        return worker
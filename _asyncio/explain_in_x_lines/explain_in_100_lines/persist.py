@@ -0,0 +1,256 @@
+"""Долговечное хранилище сервера: журнал изменений (WAL) и снимки
+
+Каждое изменение (создан пользователь, записан баланс счета) - запись фиксированного
+размера RECORD в журнал wal.<generation>. Записи копятся в памяти и уходят на диск пачкой:
+одна запись в файл и один fsync на все изменения, накопленные за group_commit (group commit).
+Пачка - заголовок BATCH (длина, crc32) и записи: недописанная при падении пачка
+при загрузке отбрасывается целиком, и хвост журнала обрезается.
+
+Все записи - присваивания, повторное применение ничего не меняет. Когда в журнале набирается
+compact_records записей, пишется снимок: колонки таблиц как есть (Table.dump), в snapshot.tmp,
+fsync и rename поверх snapshot, после чего старые журналы удаляются. При старте снимок
+отображается через mmap и колонки копируются из него целиком, затем проигрываются журналы
+поколений не старше снимка.
+
+    storage = Storage(path, users, accounts, lock)
+    storage.load()
+    storage.append(OP_ACCOUNT, account_id, balance)
+    storage.append_records([pack_record(OP_ACCOUNT, ...), pack_record(OP_USER, ...)])
+    storage.commit_later(callback)  # из EventLoop; потоки зовут storage.commit()
+"""
+import functools
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+from access_log import log
+from consts import MS
+from event_loop import set_timer, Context
+
+# op, id, два значения: OP_USER - name и account_id, OP_ACCOUNT - balance
+RECORD = struct.Struct('<Bqqq')
+OP_USER = 1
+OP_ACCOUNT = 2
+# длина пачки записей, crc32 пачки
+BATCH = struct.Struct('<II')
+
+SNAPSHOT = 'snapshot'
+SNAPSHOT_MAGIC = b'SNAP0001'
+# magic, поколение: снимок включает все журналы младших поколений
+SNAPSHOT_HEADER = struct.Struct('<8sQ')
+
+# сколько ждем попутчиков перед fsync; 0 - fsync на каждую запись
+GROUP_COMMIT_INTERVAL = 2 * MS
+# после скольких записей в журнале пишем снимок
+COMPACT_RECORDS = 1_000_000
+
+
+def pack_record(op, entity_id, a, b=0):
+    """Запись журнала; struct.error, если значение не влезает в RECORD. Пакуем до изменения
+    таблиц: не упаковалось - ни таблицы, ни журнал не тронуты"""
+    return RECORD.pack(op, int(entity_id), int(a), int(b))
+
+
+class WriteAheadLog:
+    """Файл журнала одного поколения; append и commit можно звать из разных потоков"""
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'ab', buffering=0)
+        self._buffer = bytearray()
+        self._lock = threading.Lock()
+        # пока один поток пишет пачку, следующая копится в _buffer
+        self._commit_lock = threading.Lock()
+        # records - сколько записей добавлено, durable - сколько из них уже прошло fsync
+        self.records = 0
+        self.durable = 0
+        self.fsyncs = 0
+
+    def append(self, op, entity_id, a, b=0):
+        self.append_records([pack_record(op, entity_id, a, b)])
+
+    def append_records(self, records):
+        """records - упакованные pack_record; попадают в одну пачку"""
+        with self._lock:
+            for record in records:
+                self._buffer += record
+            self.records += len(records)
+
+    def pending(self):
+        """Сколько добавленных записей еще не на диске. Пустой _buffer этого не значит:
+        commit забирает буфер до write и fsync"""
+        return self.records - self.durable
+
+    def commit(self):
+        """Пишет и fsync-ает все, что добавлено до вызова. Пачку, взятую другим потоком,
+        ждем на _commit_lock: порядок пачек в файле - порядок изменений"""
+        with self._commit_lock:
+            with self._lock:
+                body, self._buffer = self._buffer, bytearray()
+                records = self.records
+            if body:
+                self._file.write(BATCH.pack(len(body), zlib.crc32(body)) + body)
+                os.fsync(self._file.fileno())
+                self.fsyncs += 1
+            self.durable = records
+
+    def close(self):
+        self.commit()
+        self._file.close()
+
+
+class Storage(Context):
+    """Каталог path: snapshot и wal.<generation>. lock - тот же, под которым меняются таблицы"""
+    def __init__(
+        self, path, users, accounts, lock,
+        group_commit=GROUP_COMMIT_INTERVAL, compact_records=COMPACT_RECORDS,
+    ):
+        self.path = path
+        self.users = users
+        self.accounts = accounts
+        self.lock = lock
+        self.group_commit = group_commit
+        self.compact_records = compact_records
+        self.generation = 0
+        self.wal = None
+        # ждущие commit_later и таймер group commit - свои у цикла каждого потока:
+        # callback должен вернуться в тот цикл, из которого его передали
+        self._waiting = {}
+        self._timers = {}
+        os.makedirs(path, exist_ok=True)
+
+    def load(self):
+        """Снимок и журналы после него -> число проигранных записей журнала.
+        Новые записи пойдут в журнал следующего поколения"""
+        shards = [(table.stride, table.offset) for table in (self.users, self.accounts)]
+        snapshot = os.path.join(self.path, SNAPSHOT)
+        if os.path.exists(snapshot):
+            with open(snapshot, 'rb') as file:
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                    magic, self.generation = SNAPSHOT_HEADER.unpack_from(buffer)
+                    if magic != SNAPSHOT_MAGIC:
+                        raise ValueError(f'{snapshot}: not a snapshot')
+                    pos = self.users.load(buffer, SNAPSHOT_HEADER.size)
+                    self.accounts.load(buffer, pos)
+            if [(table.stride, table.offset) for table in (self.users, self.accounts)] != shards:
+                # снимок другого шарда: число воркеров поменялось
+                raise ValueError(f'{snapshot}: shard mismatch, expected (stride, offset) {shards[0]}')
+
+        replayed = 0
+        generations = self._generations()
+        for generation in generations:
+            if generation >= self.generation:
+                replayed += self._replay(self._wal_path(generation))
+        self.generation = max(generations + [self.generation]) + 1
+        self.wal = WriteAheadLog(self._wal_path(self.generation))
+        return replayed
+
+    def _replay(self, path):
+        with open(path, 'rb') as file:
+            data = memoryview(file.read())
+        put_user, put_account = self.users.put, self.accounts.put
+        replayed = 0
+        pos = 0
+        while pos + BATCH.size <= len(data):
+            length, crc = BATCH.unpack_from(data, pos)
+            body = data[pos + BATCH.size:pos + BATCH.size + length]
+            if len(body) < length or zlib.crc32(body) != crc:
+                break
+            for op, entity_id, a, b in RECORD.iter_unpack(body):
+                if op == OP_USER:
+                    put_user(entity_id, (a, b))
+                else:
+                    put_account(entity_id, (a,))
+            replayed += length // RECORD.size
+            pos += BATCH.size + length
+        if pos < len(data):
+            # пачка, недописанная при падении: ее fsync не завершился, ответов по ней не было
+            log.warning('wal tail truncated', path=path, bytes=len(data) - pos)
+            os.truncate(path, pos)
+        return replayed
+
+    def append(self, op, entity_id, a, b=0):
+        self.wal.append(op, entity_id, a, b)
+
+    def append_records(self, records):
+        self.wal.append_records(records)
+
+    def pending(self):
+        return self.wal.pending()
+
+    def commit(self):
+        """Синхронный commit для потокового сервера"""
+        self.wal.commit()
+        if self.wal.records >= self.compact_records:
+            self.compact()
+
+    def commit_later(self, callback):
+        """callback(error), когда на диске все, что добавлено до вызова. Один fsync на всех,
+        кто позвал commit_later за group_commit"""
+        loop = self.evloop
+        self._waiting.setdefault(loop, []).append(callback)
+        if not self.group_commit:
+            self._flush(loop)
+        elif loop not in self._timers:
+            self._timers[loop] = set_timer(self.group_commit, functools.partial(self._flush, loop))
+
+    def _flush(self, loop):
+        self._timers.pop(loop, None)
+        waiting = self._waiting.pop(loop, [])
+        error = None
+        try:
+            self.commit()
+        except OSError as exc:
+            log.error('wal commit failed', path=self.wal.path, error=exc)
+            error = exc
+        for callback in waiting:
+            callback(error)
+
+    def compact(self):
+        """Снимок таблиц и новый журнал; в EventLoop блокирует цикл на время записи снимка"""
+        with self.lock:
+            # другой поток мог успеть раньше
+            if self.wal.records < self.compact_records:
+                return
+            # под lock таблицы не меняются: снимок - ровно то, что в закрытых журналах
+            self.wal.close()
+            self.generation += 1
+            self.wal = WriteAheadLog(self._wal_path(self.generation))
+
+            snapshot = os.path.join(self.path, SNAPSHOT)
+            with open(snapshot + '.tmp', 'wb') as file:
+                file.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, self.generation))
+                self.users.dump(file)
+                self.accounts.dump(file)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(snapshot + '.tmp', snapshot)
+            self._fsync_dir()
+
+        for generation in self._generations():
+            if generation < self.generation:
+                os.remove(self._wal_path(generation))
+
+    def close(self):
+        for loop, timer in list(self._timers.items()):
+            timer.cancel()
+            self._flush(loop)
+        if self.wal is not None:
+            self.wal.close()
+
+    def _generations(self):
+        return sorted(
+            int(name[len('wal.'):]) for name in os.listdir(self.path) if name.startswith('wal.')
+        )
+
+    def _wal_path(self, generation):
+        return os.path.join(self.path, f'wal.{generation}')
+
+    def _fsync_dir(self):
+        # rename долговечен только после fsync каталога
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
@@ -0,0 +1,105 @@
+"""Бэкенды мультиплексора для Queue
+
+Общий интерфейс: register/modify/unregister(fileobj, ...), poll(timeout) -> [(callback, mask)],
+len() - число зарегистрированных объектов, close(). Маски - selectors.EVENT_READ/EVENT_WRITE.
+"""
+import math
+import select
+import selectors
+
+
+class SelectorPoller:
+    """selectors.DefaultSelector, срабатывание по уровню"""
+    edge_triggered = False
+
+    def __init__(self):
+        self._selector = selectors.DefaultSelector()
+
+    def __len__(self):
+        return len(self._selector.get_map())
+
+    def register(self, fileobj, events, callback):
+        self._selector.register(fileobj, events, callback)
+
+    def modify(self, fileobj, events, callback):
+        self._selector.modify(fileobj, events, callback)
+
+    def unregister(self, fileobj):
+        self._selector.unregister(fileobj)
+
+    def poll(self, timeout):
+        return [(key.data, mask) for key, mask in self._selector.select(timeout)]
+
+    def close(self):
+        self._selector.close()
+
+
+class EpollPoller:
+    """select.epoll без обертки selectors: (callback, events) лежат в плоском списке
+    по номеру fd, события забираются пачками до maxevents за вызов.
+
+    По умолчанию EPOLLET - событие приходит только на фронте готовности. Сокет,
+    который снова ждет то же направление, должен переподписаться (modify), см. _socket._update_events
+    """
+    def __init__(self, edge_triggered=True, maxevents=1024):
+        self._epoll = select.epoll()
+        self._table = []
+        self._count = 0
+        self._flags = select.EPOLLET if edge_triggered else 0
+        self._maxevents = maxevents
+        self.edge_triggered = edge_triggered
+
+    def __len__(self):
+        return self._count
+
+    def _epoll_events(self, events):
+        flags = self._flags
+        if events & selectors.EVENT_READ:
+            flags |= select.EPOLLIN
+        if events & selectors.EVENT_WRITE:
+            flags |= select.EPOLLOUT
+        return flags
+
+    def register(self, fileobj, events, callback):
+        fd = fileobj if isinstance(fileobj, int) else fileobj.fileno()
+        if fd >= len(self._table):
+            self._table.extend([None] * (fd + 1 - len(self._table)))
+        self._epoll.register(fd, self._epoll_events(events))
+        self._table[fd] = (callback, events)
+        self._count += 1
+
+    def modify(self, fileobj, events, callback):
+        fd = fileobj if isinstance(fileobj, int) else fileobj.fileno()
+        self._epoll.modify(fd, self._epoll_events(events))
+        self._table[fd] = (callback, events)
+
+    def unregister(self, fileobj):
+        fd = fileobj if isinstance(fileobj, int) else fileobj.fileno()
+        self._epoll.unregister(fd)
+        self._table[fd] = None
+        self._count -= 1
+
+    def poll(self, timeout):
+        if timeout is None:
+            timeout = -1
+        elif timeout <= 0:
+            timeout = 0
+        else:
+            # как в selectors: epoll считает в миллисекундах, округляем вверх, чтобы не крутиться вхолостую
+            timeout = math.ceil(timeout * 1e3) * 1e-3
+
+        table = self._table
+        ready = []
+        for fd, flags in self._epoll.poll(timeout, self._maxevents):
+            callback, events = table[fd]
+            mask = 0
+            # EPOLLERR/EPOLLHUP будят обе стороны, оставляем только то, на что подписаны
+            if flags & ~select.EPOLLIN:
+                mask |= selectors.EVENT_WRITE
+            if flags & ~select.EPOLLOUT:
+                mask |= selectors.EVENT_READ
+            ready.append((callback, mask & events))
+        return ready
+
+    def close(self):
+        self._epoll.close()
@@ -0,0 +1,186 @@
+"""Протокол клиент <-> сервер
+
+Запрос - ascii строка 'GET <kind> <id>\n' или 'GET <kind> <id>,<id>,...\n' (multi-get,
+не больше MAX_IDS id, ответ - массив в порядке id).
+Ответ - кадр: json документ в одну строку, завершенный \n (json.dumps не оставляет
+переводов строк внутри). Ответы идут в порядке запросов, поэтому запросы можно
+слать пачкой, не дожидаясь ответов (pipelining).
+На запрос, который сервер не смог выполнить (длиннее MAX_REQUEST_LENGTH, не разобрался,
+сущности нет), ответ - {"error": "<причина>"}, соединение остается открытым.
+
+Бинарный протокол согласуется текстовой строкой PROTO_BINARY: сервер отвечает
+{"protocol": "binary"} (или ошибкой, если не поддерживает), и с этого момента соединение
+в обе стороны идет кадрами FRAME (длина тела, kind, число записей) + тело. Тело запроса -
+id как uint32, тело ответа - записи USER_RECORD или ACCOUNT_RECORD в порядке id,
+ошибка - кадр KIND_ERROR с причиной в utf-8.
+Клиент ждет ответа на PROTO_BINARY, прежде чем слать кадры.
+"""
+import json
+import struct
+
+from consts import KB
+
+DELIMITER = b'\n'
+MAX_REQUEST_LENGTH = KB
+# с id до MAX_ID_LENGTH знаков запрос укладывается в MAX_REQUEST_LENGTH
+MAX_IDS = 100
+MAX_ID_LENGTH = 9
+
+PROTO_BINARY = b'PROTO binary'
+# длина тела, kind, число id или записей
+FRAME = struct.Struct('<IBH')
+KINDS = {'user': 1, 'account': 2}
+# kind кадра ответа-ошибки
+KIND_ERROR = 0
+KIND_NAMES = {code: kind for kind, code in KINDS.items()}
+# id в кадрах - uint32, как и в тексте: до 9 знаков
+ID = struct.Struct('<I')
+MAX_ID = 0xFFFFFFFF
+# id, account_id, name (8 hex-цифр ascii)
+USER_RECORD = struct.Struct('<II8s')
+# id, balance
+ACCOUNT_RECORD = struct.Struct('<Iq')
+RECORDS = {'user': USER_RECORD, 'account': ACCOUNT_RECORD}
+
+
+def request_ids(entity_id):
+    """entity_id - id или список id -> список int. ValueError, если какой-то id не целое
+    от 0 до MAX_ID: такой запрос не закодировать ни в текст, ни в кадр"""
+    entity_ids = entity_id if isinstance(entity_id, (list, tuple)) else [entity_id]
+    try:
+        ids = [int(entity_id) for entity_id in entity_ids]
+    except (TypeError, ValueError):
+        ids = None
+    if not ids or not all(0 <= entity_id <= MAX_ID for entity_id in ids):
+        raise ValueError(f'bad id {entity_id!r}')
+    return ids
+
+
+def encode_request(entity_kind, entity_id):
+    """entity_id - id или список id для multi-get"""
+    entity_id = ','.join(map(str, request_ids(entity_id)))
+    return f'GET {entity_kind} {entity_id}\n'.encode('ascii')
+
+
+def encode_reply(data):
+    return encode_entity(data) + DELIMITER
+
+
+def encode_entity(data):
+    """json сущности без перевода строки - кусок ответа, который можно кешировать"""
+    return json.dumps(data).encode('utf-8')
+
+
+def join_reply(parts):
+    """Кадр ответа из закодированных сущностей: одна - объект, несколько - массив.
+    Байт в байт совпадает с encode_reply от сущности или списка"""
+    if len(parts) == 1:
+        return parts[0] + DELIMITER
+    return b'[' + b', '.join(parts) + b']' + DELIMITER
+
+
+def encode_error(message):
+    return encode_reply({'error': message})
+
+
+class ReplyError(Exception):
+    """Сервер ответил на запрос ошибкой"""
+
+
+class BadRequest(Exception):
+    """Запрос не разобрать; на него отвечают ошибкой, соединение остается рабочим"""
+
+
+def decode_reply(frame):
+    """frame - bytes-like с кадром ответа, memoryview тоже подходит.
+    Ответ-ошибка поднимает ReplyError"""
+    data = json.loads(str(frame, 'utf-8'))
+    # у сущностей нет поля error
+    if isinstance(data, dict) and 'error' in data:
+        raise ReplyError(data['error'])
+    return data
+
+
+class LineParser:
+    """Разбор потока запросов на строки с ограниченным буфером
+
+    feed(chunk) -> готовые строки без разделителя. Ищем разделитель только в новом куске,
+    в буфере копится лишь незавершенный хвост, не длиннее limit. Строка длиннее limit
+    возвращается как None (сразу, как только превысила limit), ее байты до разделителя
+    выбрасываются, не занимая память"""
+    def __init__(self, limit=MAX_REQUEST_LENGTH):
+        self.limit = limit
+        self._buf = bytearray()
+        # дочитываем строку, о которой уже вернули None
+        self._skipping = False
+
+    def feed(self, chunk):
+        lines = chunk.split(DELIMITER)
+        tail = lines.pop()
+        if lines:
+            if self._skipping:
+                self._skipping = False
+                del lines[0]
+            elif self._buf:
+                lines[0] = b''.join((self._buf, lines[0]))
+                self._buf.clear()
+            # длиннее limit может быть только строка, склеенная с буфером, или из длинного куска;
+            # построчная проверка в питоне - только если такая правда есть
+            if lines and (
+                len(lines[0]) > self.limit
+                or len(chunk) > self.limit and max(map(len, lines)) > self.limit
+            ):
+                lines = [line if len(line) <= self.limit else None for line in lines]
+
+        if not self._skipping:
+            if len(self._buf) + len(tail) > self.limit:
+                lines.append(None)
+                self._buf.clear()
+                self._skipping = True
+            else:
+                self._buf += tail
+        return lines
+
+
+def encode_binary_request(entity_kind, entity_id):
+    """entity_id - id или список id для multi-get"""
+    entity_ids = request_ids(entity_id)
+    body = struct.pack(f'<{len(entity_ids)}I', *entity_ids)
+    return FRAME.pack(len(body), KINDS[entity_kind], len(entity_ids)) + body
+
+
+def decode_binary_request(header, body):
+    """header, body - кадр запроса -> (entity_kind, [entity_id, ...])"""
+    length, kind, count = FRAME.unpack(header)
+    if kind not in KIND_NAMES or not 0 < count <= MAX_IDS or length != ID.size * count:
+        raise BadRequest('bad request')
+    return KIND_NAMES[kind], list(struct.unpack(f'<{count}I', body))
+
+
+def encode_binary_reply(entity_kind, records):
+    """records - упакованные RECORDS[entity_kind]"""
+    body = b''.join(records)
+    return FRAME.pack(len(body), KINDS[entity_kind], len(records)) + body
+
+
+def encode_binary_error(message):
+    body = message.encode('utf-8')
+    return FRAME.pack(len(body), KIND_ERROR, 0) + body
+
+
+def decode_binary_reply(header, body):
+    """Как decode_reply: одна запись - dict, несколько - список, кадр ошибки - ReplyError"""
+    _, kind, count = FRAME.unpack(header)
+    if kind == KIND_ERROR:
+        raise ReplyError(str(body, 'utf-8'))
+    if kind == KINDS['user']:
+        entities = [
+            {'id': str(user_id), 'name': name.decode('ascii'), 'account_id': str(account_id)}
+            for user_id, account_id, name in USER_RECORD.iter_unpack(body)
+        ]
+    else:
+        entities = [
+            {'id': str(account_id), 'balance': balance}
+            for account_id, balance in ACCOUNT_RECORD.iter_unpack(body)
+        ]
+    return entities[0] if count == 1 else entities
@@ -1,70 +1,755 @@
+import os
 import sys
-
-import json
+import time
+import traceback
 
 import random
 
 from uuid import uuid4
 
-from socketserver import BaseRequestHandler, TCPServer
+import threading
 
-from consts import KB
+import signal
+import socket
 
+from socketserver import BaseRequestHandler, ThreadingTCPServer
 
-class Handler(BaseRequestHandler):
-    users = {}
-    accounts = {}
+from client import Client
+from consts import KB, MS, SEC
+from event_loop import _socket, hrtime, set_timer, Context, EventLoop
+from access_log import INFO, log
+from cache import LRUCache
+from multiloop import ROUND_ROBIN, LoopGroup
+from persist import OP_ACCOUNT, OP_USER, Storage, pack_record
+from protocol import (
+    ACCOUNT_RECORD, DELIMITER, FRAME, MAX_ID_LENGTH, MAX_IDS, MAX_REQUEST_LENGTH, PROTO_BINARY,
+    USER_RECORD, BadRequest, LineParser, ReplyError, decode_binary_request, encode_binary_error,
+    encode_binary_reply, encode_entity, encode_error, encode_reply, join_reply,
+)
+from store import AccountStore, UserStore
 
-    def handle(self):
-        client = f'client {self.client_address}'
-        req = self.request.recv(KB)
+# ошибки запроса, на которые отвечаем кадром ошибки, а не закрываем соединение
+REQUEST_ERRORS = (BadRequest, KeyError)
 
-        if not req:
-            print(f'{client} unexpectedly disconnected')
-            return
+# сколько закодированных сущностей держим в кеше ответов
+RESPONSE_CACHE_SIZE = 100_000
+
+
+class RequestHandler:
+    """Разбор запросов и данные, общие для потокового и асинхронного серверов"""
+    users = UserStore()
+    accounts = AccountStore()
+    # в ThreadingTCPServer соединения обслуживаются в потоках, а id счета берется из len(accounts)
+    lock = threading.Lock()
+    # (entity_kind, entity_id) -> json сущности, ('binary', entity_kind, entity_id) -> запись кадра
+    cache = LRUCache(RESPONSE_CACHE_SIZE)
+    # persist.Storage, если задан DATA_DIR: изменения пишутся в журнал до ответа
+    storage = None
+    # соглашаться ли на PROTO_BINARY; binary - соединение уже перешло на кадры
+    binary_supported = True
+    binary = False
+
+    def handle_request(self, req):
+        """req - строка запроса без перевода строки, возвращает кадр ответа"""
+        entity_kind, entity_ids = self.parse_request(req)
+        resp = join_reply([self.get_encoded(entity_kind, entity_id) for entity_id in entity_ids])
+        if log.level <= INFO:
+            log.access(self.client_address, req, resp)
+        return resp
+
+    def error_reply(self, error, binary=False):
+        """Кадр ошибки на запрос, который не выполнить (BadRequest, KeyError - сущности нет):
+        ошибка только у этого запроса, остальные в пачке и соединение не страдают"""
+        message = f'not found: {error.args[0]}' if isinstance(error, KeyError) else str(error)
+        log.warning('request failed', client=self.client_address, error=message)
+        return encode_binary_error(message) if binary else encode_error(message)
 
-        print(f'{client} < {req}')
-        req = req.decode('utf-8')
+    def switch_protocol(self):
+        """Ответ на PROTO_BINARY"""
+        if not self.binary_supported:
+            return encode_error('binary protocol not supported')
+        self.binary = True
+        return encode_reply({'protocol': 'binary'})
 
-        if req[-1] != '\n':
-            raise Exception('Max request length exceeded')
+    def handle_binary_request(self, header, body):
+        """header, body - кадр бинарного запроса, возвращает кадр ответа"""
+        entity_kind, entity_ids = decode_binary_request(header, body)
+        resp = encode_binary_reply(
+            entity_kind, [self.get_packed(entity_kind, entity_id) for entity_id in entity_ids],
+        )
+        if log.level <= INFO:
+            log.access(self.client_address, ('binary', entity_kind, len(entity_ids)), resp)
+        return resp
 
-        method, entity_kind, entity_id = req[:-1].split(' ', 3)  # asterisk
+    def get_packed(self, entity_kind, entity_id):
+        """Запись бинарного ответа; промах кеша пакуем прямо из колонок хранилища, без dict"""
+        key = ('binary', entity_kind, entity_id)
+        record = self.cache.get(key)
+        if record is not None:
+            return record
+
+        if entity_kind == 'user':
+            values = self.users.get_values(entity_id)
+            if values is None:
+                self.get_user(entity_id)
+                values = self.users.get_values(entity_id)
+            name, account_id = values
+            record = USER_RECORD.pack(entity_id, account_id, b'%08x' % name)
+        else:
+            values = self.accounts.get_values(entity_id)
+            if values is None:
+                raise KeyError(entity_id)
+            record = ACCOUNT_RECORD.pack(entity_id, *values)
+        self.cache.put(key, record)
+        return record
+
+    def get_encoded(self, entity_kind, entity_id):
+        """json сущности, на попадании в кеш - без обращения к хранилищу и json.dumps"""
+        key = (entity_kind, entity_id)
+        data = self.cache.get(key)
+        if data is None:
+            get_entity = self.get_user if entity_kind == 'user' else self.get_account
+            data = encode_entity(get_entity(entity_id))
+            self.cache.put(key, data)
+        return data
+
+    @staticmethod
+    def parse_request(req):
+        """-> (entity_kind, [entity_id, ...])"""
+        try:
+            method, entity_kind, entity_id = req.decode('utf-8').split(' ', 3)  # asterisk
+        except ValueError:
+            raise BadRequest('bad request')
+        # multi-get: 'GET user 1,2,3' - ответ массив в порядке id
+        entity_ids = entity_id.split(',')
         if (
             method != 'GET'
             or entity_kind not in ('user', 'account')
-            or not entity_id.isdigit()
+            or len(entity_ids) > MAX_IDS
+            # isdigit пропускает и не-ascii цифры ('²'), которые int не разберет
+            or not all(
+                entity_id.isascii() and entity_id.isdigit() and len(entity_id) <= MAX_ID_LENGTH
+                for entity_id in entity_ids
+            )
         ):
-            raise Exception('Bad request')
+            raise BadRequest('bad request')
+        # '007' и '7' - одна сущность и один ключ кеша
+        return entity_kind, [str(int(entity_id)) for entity_id in entity_ids]
 
-        if entity_kind == 'user':
-            user = self.users.get(entity_id) or {'id': entity_id}   # явно какая-то дичь с setdefault
-            self.users[entity_id] = user
+    def get_user(self, user_id):
+        user = self.users.get(user_id)
+        if user is not None:
+            return user
+
+        with self.lock:
+            # пока ждали lock, пользователя мог создать другой поток
+            user = self.users.get(user_id)
+            if user is None:
+                account_id = self.new_account_id()
+                balance = random.randint(0, 100)
+                name = str(uuid4()).split('-')[0]
+                if self.storage is not None:
+                    # записи журнала - до таблиц: если не упакуются, память и журнал не разойдутся
+                    records = [
+                        pack_record(OP_ACCOUNT, account_id, balance),
+                        pack_record(OP_USER, user_id, int(name, 16), account_id),
+                    ]
+                self.accounts.add(account_id, balance)
+                user = self.users.add(user_id, name, account_id)
+                if self.storage is not None:
+                    self.storage.append_records(records)
+        return user
+
+    def get_account(self, account_id):
+        account = self.accounts.get(account_id)
+        if account is None:
+            raise KeyError(account_id)
+        return account
+
+    def set_balance(self, account_id, balance):
+        with self.lock:
+            if self.storage is not None:
+                record = pack_record(OP_ACCOUNT, account_id, balance)
+            self.accounts.set_balance(account_id, balance)
+            self.cache.invalidate(('account', str(account_id)))
+            self.cache.invalidate(('binary', 'account', int(account_id)))
+            if self.storage is not None:
+                self.storage.append_records([record])
+
+    def new_account_id(self):
+        return str(len(self.accounts) + 1)
+
+
+class Handler(RequestHandler, BaseRequestHandler):
+    def handle(self):
+        # keep-alive: обслуживаем запросы, пока клиент не закроет соединение.
+        # Запрос может прийти по частям, а может пачкой: отвечаем на все полные строки
+        # из прочитанного одним sendall
+        served = 0
+        parser = LineParser(MAX_REQUEST_LENGTH)
+        while True:
+            data = self.request.recv(KB)
+
+            if not data:
+                if not served:
+                    log.warning('unexpectedly disconnected', client=self.client_address)
+                return
+
+            lines = parser.feed(data)
+            if lines:
+                self.send([self.handle_line(line) for line in lines])
+                served += len(lines)
+                if self.binary:
+                    return self.handle_binary()
+
+    def handle_line(self, line):
+        if line is None:
+            log.warning('request too long', client=self.client_address, limit=MAX_REQUEST_LENGTH)
+            return encode_error('request too long')
+        if line == PROTO_BINARY:
+            return self.switch_protocol()
+        try:
+            return self.handle_request(line)
+        except REQUEST_ERRORS as error:
+            return self.error_reply(error)
+
+    def handle_binary(self):
+        """Соединение после PROTO_BINARY: отвечаем на все полные кадры из прочитанного"""
+        buf = b''
+        while True:
+            data = self.request.recv(KB)
+            if not data:
+                return
+            buf += data
+
+            replies = []
+            pos = 0
+            while len(buf) - pos >= FRAME.size:
+                length = FRAME.unpack_from(buf, pos)[0]
+                if length > MAX_REQUEST_LENGTH:
+                    # границу следующего кадра не найти, закрываем соединение
+                    log.warning('request too long', client=self.client_address, limit=MAX_REQUEST_LENGTH)
+                    return
+                end = pos + FRAME.size + length
+                if end > len(buf):
+                    break
+                try:
+                    replies.append(self.handle_binary_request(buf[pos:pos + FRAME.size], buf[pos + FRAME.size:end]))
+                except REQUEST_ERRORS as error:
+                    replies.append(self.error_reply(error, binary=True))
+                pos = end
+            buf = buf[pos:]
+
+            if replies:
+                self.send(replies)
+
+    def send(self, replies):
+        if self.storage is not None:
+            # fsync-и потоков, пришедших за время чужого fsync, сливаются в один
+            self.storage.commit()
+        self.request.sendall(b''.join(replies))
+
+
+class AsyncHandler(RequestHandler, Context):
+    """Соединение асинхронного сервера - конечный автомат: ждем строку запроса, отвечаем,
+    ждем следующую. Пока клиент не забирает ответы и буфер записи выше high water,
+    новые запросы не читаем"""
+    def __init__(self, sock, client_address, server):
+        self.sock = sock
+        self.client_address = client_address
+        self.server = server
+        self._served = 0
+        self._reading = False
+        self._paused = False
+        self._draining = False
+        self._closed = False
+        sock.set_flow_control(self._pause_reading, self._resume_reading)
+        self._read()
+
+    def process(self, req, callback):
+        """callback(error, resp); наследники могут отвечать асинхронно"""
+        try:
+            resp = self.handle_request(req)
+        except REQUEST_ERRORS as error:
+            return callback(None, self.error_reply(error))
+        except Exception as error:
+            return callback(error)
+        self.commit(resp, callback)
+
+    def commit(self, resp, callback):
+        """Отвечаем, когда в журнале на диске все изменения, которые ответ мог увидеть"""
+        # pending считает и пачку, которую другой цикл сейчас пишет и fsync-ает
+        if self.storage is None or not self.storage.pending():
+            return callback(None, resp)
+
+        def on_commit(error):
+            if error:
+                return callback(error)
+            callback(None, resp)
+
+        self.storage.commit_later(on_commit)
+
+    def process_binary(self, header, body, callback):
+        """Кадр бинарного запроса; body действителен только до возврата"""
+        try:
+            resp = self.handle_binary_request(header, body)
+        except REQUEST_ERRORS as error:
+            return callback(None, self.error_reply(error, binary=True))
+        except Exception as error:
+            return callback(error)
+        self.commit(resp, callback)
+
+    def _read(self):
+        if not (self._reading or self._paused or self._closed):
+            self._reading = True
+            if self.binary:
+                self.sock.recv_exactly(FRAME.size, self._on_frame_header)
+            else:
+                self.sock.recv_until(DELIMITER, self._on_request, limit=MAX_REQUEST_LENGTH)
+
+    def _on_frame_header(self, error, header=None):
+        if error:
+            return self._on_request(error)
+        header = bytes(header)
+        length = FRAME.unpack(header)[0]
+        if length > MAX_REQUEST_LENGTH:
+            return self._on_request(IOError('message too long', MAX_REQUEST_LENGTH))
+
+        def _on_body(error, body=None):
+            if error:
+                return self._on_request(error)
+            self._reading = False
+            self.process_binary(header, body, self._on_response)
+
+        self.sock.recv_exactly(length, _on_body)
+
+    def _on_request(self, error, req=None):
+        self._reading = False
+        if error and error.args[:1] == ('message too long',) and not self.binary:
+            # как LineParser в Handler: отвечаем ошибкой, дочитываем строку до конца и живем дальше
+            log.warning('request too long', client=self.client_address, limit=MAX_REQUEST_LENGTH)
+            self._reading = True
+            return self.sock.skip_until(DELIMITER, self._on_skipped)
+        if error:
+            # ('connection closed', 0) - клиент закрыл соединение между запросами
+            if error.args != ('connection closed', 0):
+                log.warning('read failed', client=self.client_address, error=error)
+            elif not self._served:
+                log.warning('unexpectedly disconnected', client=self.client_address)
+            return self.close()
+
+        req = bytes(req[:-len(DELIMITER)])
+        if req == PROTO_BINARY:
+            return self._on_response(None, self.switch_protocol())
+        self.process(req, self._on_response)
+
+    def _on_skipped(self, error):
+        self._reading = False
+        if error:
+            return self._on_request(error)
+        self._on_response(None, encode_error('request too long'))
+
+    def _on_response(self, error, resp=None):
+        if self._closed:
+            return
+        if error:
+            log.error('request failed', client=self.client_address, error=repr(error))
+            return self.close()
+        self._served += 1
+        self.send([resp])
+        if self._draining and not self.sock.get_read_buffer_size():
+            # больше запросов не ждем, соединение закроет _on_sent
+            return
+        self._read()
+
+    def send(self, replies):
+        # ответы, набранные за итерацию цикла, уйдут одним sendmsg
+        self.sock.sendall(replies, self._on_sent)
+
+    def _on_sent(self, error):
+        if error or (self._draining and not self._reading and not self.sock.get_write_buffer_size()):
+            self.close()
+
+    def _pause_reading(self):
+        self._paused = True
+
+    def _resume_reading(self):
+        self._paused = False
+        self._read()
+
+    def drain(self):
+        """Дорабатываем начатый запрос и закрываемся; простаивающее соединение закрываем сразу"""
+        self._draining = True
+        if (
+            self._reading
+            and not self.sock.get_read_buffer_size()
+            and not self.sock.get_write_buffer_size()
+        ):
+            self.close()
 
-            if 'name' not in user:
-                user['name'] = str(uuid4()).split('-')[0]
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self.sock.close()
+            self.server.close_request(self)
 
-            if 'aacount_id' not in user:
-                account_id = str(len(self.accounts) + 1)
-                account = {'id': account_id, 'balance': random.randint(0, 100)}
-                self.accounts[account_id] = account
-                user['account_id'] = account_id
 
-            self.send(user)
+class AsyncServer(Context):
+    """Сервер на EventLoop: все соединения обслуживаются в одном потоке
+
+    sock - уже слушающий socket.socket (например, созданный до fork), тогда addr не нужен"""
+    def __init__(self, addr, handler_class=AsyncHandler, reuse_port=False, sock=None):
+        self.handler_class = handler_class
+        self.connections = set()
+        self._on_drained = None
+        if sock is not None:
+            self.socket = _socket(sock=sock)
+        else:
+            self.socket = _socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.socket.bind(addr, reuse_port)
+            self.socket.listen()
+        self.socket.accept(self._on_accept)
+
+    def _on_accept(self, error, sock=None, client_address=None):
+        if error:
+            log.error('accept failed', error=error)
+            return
+        self.connections.add(self.handler_class(sock, client_address, self))
+
+    def close_request(self, handler):
+        self.connections.discard(handler)
+        if self._on_drained and not self.connections:
+            self._on_drained, on_drained = None, self._on_drained
+            on_drained()
+
+    def drain(self, callback):
+        """Перестаем принимать соединения, открытые дорабатывают запросы;
+        callback() - когда закрылось последнее"""
+        self.close()
+        self._on_drained = callback
+        for handler in list(self.connections):
+            handler.drain()
+        if not self.connections:
+            self.close_request(None)
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+
+class LoopConnections:
+    """Соединения, которые MultiLoopServer отдал циклу одного потока: server для AsyncHandler"""
+    def __init__(self):
+        # handler -> done(): соединение закрылось, нагрузка цикла уменьшилась
+        self.connections = {}
+
+    def serve(self, sock, client_address, handler_class, done):
+        handler = handler_class(_socket(sock=sock), client_address, self)
+        if handler._closed:
+            return done(None)
+        self.connections[handler] = done
+
+    def close_request(self, handler):
+        done = self.connections.pop(handler, None)
+        if done is not None:
+            done(None)
+
+
+class MultiLoopServer(AsyncServer):
+    """Принимает соединения в своем цикле и раздает их циклам LoopGroup: соединение
+    живет на выбранном цикле до закрытия, LEAST_LOADED - циклу с наименьшим числом открытых"""
+    def __init__(self, addr, loops, handler_class=AsyncHandler):
+        self.loops = loops
+        super().__init__(addr, handler_class)
+
+    def _on_accept(self, error, sock=None, client_address=None):
+        if error:
+            log.error('accept failed', error=error)
             return
+        self.loops.dispatch(
+            LoopConnections.serve, sock.detach(), client_address, self.handler_class, _ignore,
+        )
+
+
+def _ignore(error=None):
+    pass
+
+
+class ShardedHandler(AsyncHandler):
+    """Соединение воркера prefork-сервера
+
+    Воркер index из count владеет пользователями и счетами с int(id) % count == index.
+    Запросы к чужим id пересылаются владельцу через pipelined Client на его внутренний адрес,
+    счета воркер нумерует так, чтобы они попадали в его же шард. Данные шарда живут в памяти
+    воркера: перезапущенный воркер начинает с пустого шарда, если не задан DATA_DIR"""
+    shard = (0, 1)
+    # index -> Client на внутренний адрес воркера
+    peers = {}
+    # process разбирает только текстовые запросы: клиент останется на тексте
+    binary_supported = False
+
+    def process(self, req, callback):
+        def reply(resp):
+            if log.level <= INFO:
+                log.access(self.client_address, req, resp)
+            self.commit(resp, callback)
+
+        try:
+            entity_kind, entity_ids = self.parse_request(req)
+        except BadRequest as error:
+            return callback(None, self.error_reply(error))
+
+        index, count = self.shard
+        # закодированные сущности в порядке ответа; кешируем только свои - чужие
+        # меняются в другом процессе, и инвалидацию оттуда не увидеть
+        parts = [None] * len(entity_ids)
+        # владелец -> [(позиция в ответе, id)]
+        remote = {}
+        try:
+            for n, entity_id in enumerate(entity_ids):
+                owner = int(entity_id) % count
+                if owner == index:
+                    parts[n] = self.get_encoded(entity_kind, entity_id)
+                else:
+                    remote.setdefault(owner, []).append((n, entity_id))
+        except REQUEST_ERRORS as error:
+            return callback(None, self.error_reply(error))
+        except Exception as error:
+            return callback(error)
+
+        if not remote:
+            return reply(join_reply(parts))
+
+        pending = len(remote)
+        failed = False
+
+        def forward(owner, items, retry):
+            def _on_reply(error, found=None):
+                nonlocal pending, failed
+                if failed:
+                    return
+                if isinstance(error, ReplyError):
+                    # владелец ответил ошибкой - отдаем ее клиенту, соединение исправно
+                    failed = True
+                    return callback(None, self.error_reply(error))
+                if error and retry:
+                    # соединение к перезапущенному воркеру протухло; GET идемпотентен, повторяем
+                    return forward(owner, items, retry=False)
+                if error:
+                    failed = True
+                    return callback(error)
+                for (n, _), entity in zip(items, found):
+                    parts[n] = encode_entity(entity)
+                pending -= 1
+                if not pending:
+                    reply(join_reply(parts))
+
+            peer = self.peers[owner]
+            ids = [entity_id for _, entity_id in items]
+            if entity_kind == 'user':
+                peer.get_users(ids, _on_reply)
+            else:
+                peer.get_balances(ids, _on_reply)
 
-        if entity_kind == 'account':
-            account = self.accounts[entity_id]
-            self.send(account)
+        for owner, items in remote.items():
+            forward(owner, items, retry=True)
+
+    def new_account_id(self):
+        index, count = self.shard
+        return str((len(self.accounts) + 1) * count + index)
+
+
+class Supervisor:
+    """prefork: workers процессов с EventLoop на одном порту через SO_REUSEPORT
+
+    Упавший воркер перезапускается, по SIGTERM/SIGINT воркеры дренируются: перестают
+    принимать соединения и закрывают открытые, доработав начатые запросы"""
+    # сколько воркер дорабатывает запросы перед принудительным выходом
+    drain_timeout = 10 * SEC
+    # воркер, упавший быстрее restart_window после запуска, перезапускается с задержкой,
+    # удваивающейся до max_restart_delay; проживший дольше - сразу
+    restart_window = 1 * SEC
+    min_restart_delay = 100 * MS
+    max_restart_delay = 30 * SEC
+
+    def __init__(self, addr, workers):
+        self.addr = addr
+        # внутренние адреса для пересылки запросов между шардами; слушающие сокеты создаем
+        # до fork, так перезапущенный воркер получает прежний адрес
+        self.internal = []
+        for _ in range(workers):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.bind(('127.0.0.1', 0))
+            sock.listen()
+            self.internal.append(sock)
+        # pid -> index
+        self.pids = {}
+        # index -> (время запуска, задержка перед ним)
+        self._spawned = {}
+        self._stopping = False
+
+    def serve_forever(self):
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        for index in range(len(self.internal)):
+            self._spawn(index)
+
+        while self.pids:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            index = self.pids.pop(pid, None)
+            if index is not None and not self._stopping:
+                delay = self._restart_delay(index)
+                log.warning('worker restarted', worker=index, status=status, delay=delay)
+                self._spawn(index, delay)
+
+    def _restart_delay(self, index):
+        spawned_at, delay = self._spawned[index]
+        if hrtime() - spawned_at - delay > self.restart_window:
+            return 0
+        return min(max(delay * 2, self.min_restart_delay), self.max_restart_delay)
+
+    def _spawn(self, index, delay=0):
+        self._spawned[index] = (hrtime(), delay)
+        pid = os.fork()
+        if pid:
+            self.pids[pid] = index
             return
 
-    def send(self, data):
-        resp = json.dumps(data).encode('utf-8')
-        print(f'client {self.client_address} > {resp}')
-        self.request.sendall(resp)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        status = 1
+        try:
+            # ждем в воркере, а не в супервизоре: тот продолжает собирать остальных
+            time.sleep(delay / SEC)
+            self._run_worker(index)
+            status = 0
+        except Exception as error:
+            log.error('worker failed', worker=index, error=repr(error))
+            traceback.print_exc()
+        finally:
+            # atexit после os._exit не сработает, дописываем журнал сами
+            log.close()
+            os._exit(status)
+
+    def _run_worker(self, index):
+        peer_addrs = [sock.getsockname() for sock in self.internal]
+        for n, sock in enumerate(self.internal):
+            if n != index:
+                sock.close()
+
+        event_loop = EventLoop()
+        Context.set_event_loop(event_loop)
+        ShardedHandler.shard = (index, len(peer_addrs))
+        # колонки шарда плотные: строка - id // workers
+        ShardedHandler.users = UserStore(stride=len(peer_addrs), offset=index)
+        ShardedHandler.accounts = AccountStore(stride=len(peer_addrs), offset=index)
+        if os.environ.get('DATA_DIR'):
+            open_storage(os.path.join(os.environ['DATA_DIR'], f'worker-{index}'), ShardedHandler)
+
+        def main():
+            ShardedHandler.peers = {
+                n: Client(addr, pipeline=True) for n, addr in enumerate(peer_addrs) if n != index
+            }
+            public = AsyncServer(self.addr, ShardedHandler, reuse_port=True)
+            internal = AsyncServer(None, ShardedHandler, sock=self.internal[index])
+
+            def on_drained():
+                timer.cancel()
+                internal.drain(lambda: None)
+                for peer in ShardedHandler.peers.values():
+                    peer.close()
+
+            def on_timeout():
+                log.error('drain timeout', worker=index, connections=len(public.connections))
+                log.close()
+                os._exit(1)
+
+            def shutdown():
+                nonlocal timer
+                if timer is None:
+                    timer = set_timer(self.drain_timeout, on_timeout)
+                    public.drain(on_drained)
+
+            timer = None
+            event_loop.add_signal_handler(signal.SIGTERM, shutdown)
+            event_loop.add_signal_handler(signal.SIGINT, shutdown)
+
+        event_loop.run(main)
+        if ShardedHandler.storage is not None:
+            ShardedHandler.storage.close()
+
+    def _stop(self, signum, frame):
+        self._stopping = True
+        for pid in list(self.pids):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                # воркер уже вышел, os.wait() заберет его статус
+                pass
+
+
+def open_storage(path, handler_class):
+    """Загружает данные из path в таблицы handler_class и включает журнал"""
+    storage = Storage(path, handler_class.users, handler_class.accounts, handler_class.lock)
+    started = time.perf_counter()
+    replayed = storage.load()
+    log.info(
+        'storage loaded', path=path, users=len(handler_class.users),
+        accounts=len(handler_class.accounts), replayed=replayed,
+        seconds=round(time.perf_counter() - started, 3),
+    )
+    handler_class.storage = storage
 
 
 if __name__ == '__main__':
     port = int(sys.argv[1])
-    with TCPServer(('127.0.0.1', port), Handler) as server:
+    # async - EventLoop в одном потоке, threading - поток на соединение,
+    # prefork [workers] - процесс с EventLoop на ядро,
+    # loops [n] [policy] - n потоков с EventLoop, соединения раздает цикл главного потока
+    mode = sys.argv[2] if len(sys.argv) > 2 else 'async'
+    # DATA_DIR - каталог журнала и снимков; без него данные живут только в памяти
+    data_dir = os.environ.get('DATA_DIR')
+
+    if mode == 'prefork':
+        workers = int(sys.argv[3]) if len(sys.argv) > 3 else os.cpu_count()
+        Supervisor(('127.0.0.1', port), workers).serve_forever()
+        sys.exit()
+
+    if data_dir:
+        open_storage(data_dir, RequestHandler)
+
+    if mode == 'async':
+        event_loop = EventLoop()
+        Context.set_event_loop(event_loop)
+        try:
+            event_loop.run(AsyncServer, ('127.0.0.1', port))
+        finally:
+            if RequestHandler.storage is not None:
+                RequestHandler.storage.close()
+        sys.exit()
+
+    if mode == 'loops':
+        loops = LoopGroup(
+            int(sys.argv[3]) if len(sys.argv) > 3 else os.cpu_count(),
+            sys.argv[4] if len(sys.argv) > 4 else ROUND_ROBIN,
+            setup=LoopConnections,
+        )
+        loops.start()
+        event_loop = EventLoop()
+        Context.set_event_loop(event_loop)
+        try:
+            event_loop.run(MultiLoopServer, ('127.0.0.1', port), loops)
+        finally:
+            if RequestHandler.storage is not None:
+                RequestHandler.storage.close()
+        sys.exit()
+
+    # keep-alive соединение занимает обработчик до закрытия клиентом: в однопоточном
+    # TCPServer остальные соединения из пула клиента ждали бы бесконечно
+    ThreadingTCPServer.daemon_threads = True
+    with ThreadingTCPServer(('127.0.0.1', port), Handler) as server:
         server.serve_forever()
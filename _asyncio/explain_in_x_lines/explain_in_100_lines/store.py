@@ -0,0 +1,199 @@
+"""Компактное хранилище сущностей сервера
+
+Вместо dict of dicts (на пользователя - dict и три str, десятки байт заголовков на каждый
+объект) - struct-of-arrays: колонки array.array фиксированного типа, строка таблицы
+вычисляется из целого id. Строки далеко за концом колонок (редкие огромные id) уходят
+в словарь переполнения, так что колонки всегда заполнены хотя бы на 1/DENSITY.
+
+Шард prefork-сервера владеет id с id % stride == offset, поэтому строка - (id - offset) // stride,
+и колонки шарда остаются плотными.
+"""
+import struct
+from array import array
+
+# колонки растут, только пока занята хотя бы 1/DENSITY строк (и первые DENSE_SLACK строк всегда)
+DENSITY = 4
+DENSE_SLACK = 64 * 1024
+
+# stride, offset, строк в колонках, сущностей, строк в переполнении
+TABLE_HEADER = struct.Struct('<qqQQQ')
+
+
+class Table:
+    """Колонки одинаковой длины; present[row] - занята ли строка"""
+    def __init__(self, columns, stride=1, offset=0):
+        """columns - [(имя, typecode array)]"""
+        self.stride = stride
+        self.offset = offset
+        self._names = [name for name, _ in columns]
+        self._columns = [array(typecode) for _, typecode in columns]
+        self._present = bytearray()
+        # row -> tuple значений
+        self._overflow = {}
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, entity_id):
+        return self.get_values(entity_id) is not None
+
+    def _row(self, entity_id):
+        row, rem = divmod(int(entity_id) - self.offset, self.stride)
+        if row < 0 or rem:
+            raise KeyError(entity_id)
+        return row
+
+    def get_values(self, entity_id):
+        """-> tuple сырых значений колонок или None"""
+        row = self._row(entity_id)
+        if row < len(self._present):
+            if self._present[row]:
+                return tuple(column[row] for column in self._columns)
+            return None
+        return self._overflow.get(row)
+
+    def put(self, entity_id, values):
+        """values - сырые значения колонок в порядке columns"""
+        row = self._row(entity_id)
+        if row >= len(self._present):
+            if row >= DENSITY * self._size + DENSE_SLACK:
+                if row not in self._overflow:
+                    self._size += 1
+                self._overflow[row] = tuple(values)
+                return
+            self._grow(row + 1)
+
+        # читатели (get в потоках сервера) идут без блокировки и верят present:
+        # сначала все колонки, потом флаг
+        for column, value in zip(self._columns, values):
+            column[row] = value
+        if not self._present[row]:
+            self._present[row] = 1
+            self._size += 1
+
+    def _set(self, entity_id, name, value):
+        row = self._row(entity_id)
+        n = self._names.index(name)
+        if row < len(self._present) and self._present[row]:
+            self._columns[n][row] = value
+            return
+        values = list(self._overflow[row])
+        values[n] = value
+        self._overflow[row] = tuple(values)
+
+    def dump(self, file):
+        """Пишет таблицу в file: заголовок, present и колонки как есть, без копирования"""
+        file.write(TABLE_HEADER.pack(
+            self.stride, self.offset, len(self._present), self._size, len(self._overflow),
+        ))
+        file.write(self._present)
+        for column in self._columns:
+            file.write(memoryview(column))
+        row_format = struct.Struct(f'<q{len(self._columns)}q')
+        for row, values in self._overflow.items():
+            file.write(row_format.pack(row, *values))
+
+    def load(self, buffer, pos=0):
+        """Читает таблицу, записанную dump, из buffer (bytes, mmap) с позиции pos,
+        возвращает позицию за ней. Колонки заполняются одним memcpy на колонку"""
+        self.stride, self.offset, rows, self._size, overflow = TABLE_HEADER.unpack_from(buffer, pos)
+        pos += TABLE_HEADER.size
+        view = memoryview(buffer)
+        self._present = bytearray(view[pos:pos + rows])
+        pos += rows
+        for n, column in enumerate(self._columns):
+            column = self._columns[n] = array(column.typecode)
+            column.frombytes(view[pos:pos + rows * column.itemsize])
+            pos += rows * column.itemsize
+        row_format = struct.Struct(f'<q{len(self._columns)}q')
+        self._overflow = {}
+        for _ in range(overflow):
+            row, *values = row_format.unpack_from(buffer, pos)
+            self._overflow[row] = tuple(values)
+            pos += row_format.size
+        view.release()
+        return pos
+
+    def _grow(self, size):
+        # удваиваем, как list: амортизированно O(1) на вставку
+        size = max(size, 2 * len(self._present))
+        extra = size - len(self._present)
+        for column in self._columns:
+            column.frombytes(bytes(extra * column.itemsize))
+        # строки из переполнения, попавшие в новый диапазон, переносим в колонки до того,
+        # как present их откроет: читатель без блокировки не должен увидеть ни нули, ни дыру
+        moved = [row for row in self._overflow if row < size]
+        for row in moved:
+            for column, value in zip(self._columns, self._overflow[row]):
+                column[row] = value
+        present = bytearray(extra)
+        for row in moved:
+            present[row - len(self._present)] = 1
+        self._present.extend(present)
+        for row in moved:
+            del self._overflow[row]
+
+
+class UserStore(Table):
+    """name - первые 8 hex-цифр uuid4, храним как uint32"""
+    def __init__(self, stride=1, offset=0):
+        super().__init__([('name', 'I'), ('account_id', 'q')], stride, offset)
+        self._name, self._account_id = self._columns
+
+    def load(self, buffer, pos=0):
+        pos = super().load(buffer, pos)
+        self._name, self._account_id = self._columns
+        return pos
+
+    def get(self, user_id):
+        """-> {'id', 'name', 'account_id'} или None"""
+        # горячий путь: колонки читаем напрямую, без общего Table.get_values
+        row = self._row(user_id)
+        if row < len(self._present):
+            if not self._present[row]:
+                return None
+            name, account_id = self._name[row], self._account_id[row]
+        else:
+            values = self._overflow.get(row)
+            if values is None:
+                return None
+            name, account_id = values
+        return {'id': str(user_id), 'name': '%08x' % name, 'account_id': str(account_id)}
+
+    def add(self, user_id, name, account_id):
+        """name - hex-строка из 8 цифр"""
+        self.put(user_id, (int(name, 16), int(account_id)))
+        return self.get(user_id)
+
+
+class AccountStore(Table):
+    def __init__(self, stride=1, offset=0):
+        super().__init__([('balance', 'q')], stride, offset)
+        self._balance, = self._columns
+
+    def load(self, buffer, pos=0):
+        pos = super().load(buffer, pos)
+        self._balance, = self._columns
+        return pos
+
+    def get(self, account_id):
+        """-> {'id', 'balance'} или None"""
+        row = self._row(account_id)
+        if row < len(self._present):
+            if not self._present[row]:
+                return None
+            balance = self._balance[row]
+        else:
+            values = self._overflow.get(row)
+            if values is None:
+                return None
+            balance, = values
+        return {'id': str(account_id), 'balance': balance}
+
+    def add(self, account_id, balance):
+        self.put(account_id, (balance,))
+        return self.get(account_id)
+
+    def set_balance(self, account_id, balance):
+        self._set(account_id, 'balance', balance)
@@ -0,0 +1,172 @@
+"""Иерархическое колесо таймеров (Varghese & Lauck, как timer wheel в ядре linux)
+
+Время делится на слоты по resolution тиков. Нижний уровень - 256 слотов по одному,
+каждый следующий - 64 слота, покрывающих весь предыдущий уровень. Таймер кладется
+в слот по тому, насколько далеко его срок; когда нижний уровень проходит круг,
+очередной слот верхнего уровня "осыпается" (cascade) вниз.
+
+Вставка и отмена - O(1): слот это dict, хендл помнит свой слот.
+"""
+
+LEVEL0_BITS = 8
+LEVEL_BITS = 6
+LEVELS = 5
+
+LEVEL0_SIZE = 1 << LEVEL0_BITS
+LEVEL_SIZE = 1 << LEVEL_BITS
+LEVEL0_MASK = LEVEL0_SIZE - 1
+LEVEL_MASK = LEVEL_SIZE - 1
+
+
+class TimerHandle:
+    """Возвращается из set_timer, позволяет отменить таймер"""
+    __slots__ = ('when', 'callback', '_expires', '_slot', '_level', '_wheel')
+
+    def __init__(self, when, callback, wheel):
+        self.when = when
+        self.callback = callback
+        self._expires = 0
+        self._slot = None
+        self._level = 0
+        self._wheel = wheel
+
+    def cancel(self):
+        """Таймер, уже вынутый из колеса, но еще не запущенный, тоже не сработает"""
+        if self._slot is not None:
+            self._wheel._remove(self)
+        self._wheel = None
+
+    def cancelled(self):
+        return self._wheel is None
+
+    def _run(self):
+        if self._wheel is not None:
+            self.callback()
+
+
+class TimerWheel:
+    def __init__(self, now, resolution):
+        """now - текущее время в тиках, resolution - ширина слота в тиках"""
+        self._resolution = resolution
+        # следующий необработанный слот: все, что раньше, уже сработало
+        self._now = now // resolution
+        self._wheels = [[{} for _ in range(LEVEL0_SIZE)]]
+        self._wheels += [[{} for _ in range(LEVEL_SIZE)] for _ in range(LEVELS - 1)]
+        self._counts = [0] * LEVELS
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def add(self, when, callback):
+        handle = TimerHandle(when, callback, self)
+        # округляем вверх, чтобы не сработать раньше срока
+        handle._expires = -(-when // self._resolution)
+        self._insert(handle)
+        self._count += 1
+        return handle
+
+    def _insert(self, handle):
+        expires = max(handle._expires, self._now)
+        delta = expires - self._now
+
+        if delta < LEVEL0_SIZE:
+            level, index = 0, expires & LEVEL0_MASK
+        else:
+            shift = LEVEL0_BITS
+            level = 1
+            while level < LEVELS - 1 and delta >= 1 << (shift + LEVEL_BITS):
+                shift += LEVEL_BITS
+                level += 1
+            if delta >= 1 << (shift + LEVEL_BITS):
+                # дальше последнего уровня - кладем в самый дальний слот, потом осыплется еще раз
+                expires = self._now + (1 << (shift + LEVEL_BITS)) - 1
+            index = (expires >> shift) & LEVEL_MASK
+
+        slot = self._wheels[level][index]
+        slot[handle] = None
+        handle._slot = slot
+        handle._level = level
+        self._counts[level] += 1
+
+    def _remove(self, handle):
+        del handle._slot[handle]
+        self._counts[handle._level] -= 1
+        self._count -= 1
+        handle._slot = None
+
+    def _cascade(self):
+        """Нижний уровень прошел круг: раскладываем очередной слот верхних уровней"""
+        shift = LEVEL0_BITS
+        for level in range(1, LEVELS):
+            index = (self._now >> shift) & LEVEL_MASK
+            slot = self._wheels[level][index]
+            if slot:
+                self._wheels[level][index] = {}
+                self._counts[level] -= len(slot)
+                for handle in slot:
+                    self._insert(handle)
+            if index:
+                break
+            shift += LEVEL_BITS
+
+    def expire(self, now):
+        """Вынимает все таймеры со сроком <= now, возвращает список хендлов"""
+        expired = []
+        if not self._count:
+            self._now = max(self._now, now // self._resolution + 1)
+            return expired
+
+        target = now // self._resolution
+        wheel = self._wheels[0]
+        while self._now <= target:
+            index = self._now & LEVEL0_MASK
+            if not index:
+                self._cascade()
+
+            if not self._counts[0]:
+                if not self._count:
+                    self._now = target + 1
+                    break
+                # нижние уровни пусты - перепрыгиваем сразу к осыпанию первого непустого
+                level = 1
+                while not self._counts[level]:
+                    level += 1
+                span_mask = (1 << (LEVEL0_BITS + LEVEL_BITS * (level - 1))) - 1
+                self._now = min(target, self._now | span_mask) + 1
+                continue
+
+            slot = wheel[index]
+            if slot:
+                wheel[index] = {}
+                self._counts[0] -= len(slot)
+                self._count -= len(slot)
+                for handle in slot:
+                    handle._slot = None
+                expired.extend(slot)
+            self._now += 1
+
+        return expired
+
+    def next_expiry(self):
+        """Нижняя оценка срока ближайшего таймера в тиках или None.
+        Точна для нижнего уровня; для верхних возвращает момент ближайшего осыпания"""
+        if not self._count:
+            return None
+
+        if not self._now & LEVEL0_MASK and self._count != self._counts[0]:
+            # осыпание на текущей границе еще не выполнено
+            return self._now * self._resolution
+
+        if self._counts[0]:
+            wheel = self._wheels[0]
+            for slot_no in range(self._now, (self._now | LEVEL0_MASK) + 1):
+                if wheel[slot_no & LEVEL0_MASK]:
+                    return slot_no * self._resolution
+            return ((self._now | LEVEL0_MASK) + 1) * self._resolution
+
+        level = 1
+        while not self._counts[level]:
+            level += 1
+        span_mask = (1 << (LEVEL0_BITS + LEVEL_BITS * (level - 1))) - 1
+        return ((self._now + span_mask) & ~span_mask) * self._resolution
@@ -1,62 +1,91 @@
 import heapq
+import itertools
+import selectors
 import time
-
-from datetime import datetime, timedelta
-
-
-class Task:
-
-    def __init__(self, waiting_until, coro):
-        self.coro = coro
-        self.waiting_until = waiting_until
-
-    def __eq__(self, other):
-        return self.waiting_until == other.waiting_until
-
-    def __lt__(self, other):
-        return self.waiting_until < other.waiting_until
+import types
 
 
 class SleepingLoop:
+    """Цикл, который будит сопрограммы по сроку или по готовности файла
+
+    Сопрограмма останавливается, отдавая (yield) циклу, чего ждет:
+      - float - срок пробуждения по time.monotonic() (sleep);
+      - (events, fileobj) - готовность файла на чтение/запись (wait_readable/wait_writable).
+    Спящие лежат в куче кортежей (deadline, seq, coro): сравниваются float, seq не дает
+    дойти до сравнения сопрограмм при равных сроках. Часы читаем раз за итерацию
+    и будим разом всех, чей срок прошел.
+    """
     def __init__(self, *coros):
         self._new = coros
         self._waiting = []
+        self._seq = itertools.count()
+        self._selector = selectors.DefaultSelector()
 
     def run_until_complete(self):
+        waiting, selector = self._waiting, self._selector
         for coro in self._new:
-            wait_for = coro.send(None)
-            heapq.heappush(self._waiting, Task(wait_for, coro))
-
-        while self._waiting:
-            now = datetime.now()
-            task = heapq.heappop(self._waiting)
-            if now < task.waiting_until:
-                delta = task.waiting_until - now
-                time.sleep(delta.total_seconds())
-                now = datetime.now()
+            self._step(coro, None)
+
+        while waiting or selector.get_map():
+            timeout = None
+            if waiting:
+                timeout = max(waiting[0][0] - time.monotonic(), 0)
+            for key, _ in selector.select(timeout):
+                selector.unregister(key.fileobj)
+                self._step(key.data, None)
+
+            now = time.monotonic()
+            ready = []
+            while waiting and waiting[0][0] <= now:
+                ready.append(heapq.heappop(waiting)[2])
+            # сопрограммы, уснувшие снова, попадут в кучу и проснутся не раньше следующей итерации
+            self._resume(ready, now)
+
+        selector.close()
+
+    def _resume(self, coros, value):
+        # горячий путь - вызов на пачку, а не на каждую сопрограмму
+        waiting, seq, heappush = self._waiting, self._seq, heapq.heappush
+        for coro in coros:
             try:
-                wait_until = task.coro.send(now)
-                heapq.heappush(self._waiting, Task(wait_until, task.coro))
+                wait_for = coro.send(value)
             except StopIteration:
-                pass
+                continue
+            if wait_for.__class__ is float:
+                heappush(waiting, (wait_for, next(seq), coro))
+            else:
+                events, fileobj = wait_for
+                self._selector.register(fileobj, events, coro)
+
+    def _step(self, coro, value):
+        self._resume((coro,), value)
+
 
-import types
 @types.coroutine
 def sleep(seconds):
-    now = datetime.now()
-    wait_until = now + timedelta(seconds=seconds)
+    now = time.monotonic()
     # останавливаем все сопрограммы в текущем стеке
-    actual = yield wait_until
-    # возобнавляем стек, возвращая время ожидания
+    actual = yield now + seconds
+    # возобновляем стек, возвращая время ожидания
     return actual - now
 
 
+@types.coroutine
+def wait_readable(fileobj):
+    yield selectors.EVENT_READ, fileobj
+
+
+@types.coroutine
+def wait_writable(fileobj):
+    yield selectors.EVENT_WRITE, fileobj
+
+
 async def countdown(label, wait_for, *, delay=0):
     """Начинает обратный отсчет от wait_for с delay
     Иммитация пользовательского кода"""
     print('%s waiting %s seconds before starting countdown' % (label, delay))
     delta = await sleep(delay)
-    print('%s starting after waiting %s' %(label, delay))
+    print('%s starting after waiting %s' % (label, delay))
     while wait_for:
         print('%s T-minus %s' % (label, wait_for))
         waited = await sleep(1)
@@ -64,31 +93,41 @@ async def countdown(label, wait_for, *, delay=0):
     print('%s lift-off!' % label)
 
 
-# Запустить el с обратным отсчетом 3х отдельных таймеров
-
-loop = SleepingLoop(
-    countdown('A', 5),
-    countdown('B', 3, delay=2),
-    countdown('C', 4, delay=1),
-)
-start = datetime.now()
-loop.run_until_complete()
-print('Elapsed: %s' % (datetime.now() - start))
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+async def echo(label, sock, messages):
+    """Ввод-вывод вперемешку со сном: пишем в socketpair, ждем ответ"""
+    for message in messages:
+        await wait_writable(sock)
+        sock.send(message)
+        await wait_readable(sock)
+        print('%s got %r' % (label, sock.recv(1024)))
+        await sleep(1.5)
+    sock.close()
+
+
+async def reply(sock):
+    while True:
+        await wait_readable(sock)
+        data = sock.recv(1024)
+        if not data:
+            return sock.close()
+        sock.send(data.upper())
+
+
+if __name__ == '__main__':
+    import socket
+
+    left, right = socket.socketpair()
+    for sock in (left, right):
+        sock.setblocking(False)
+
+    # Запустить el с обратным отсчетом 3х отдельных таймеров и эхом через socketpair
+    loop = SleepingLoop(
+        countdown('A', 5),
+        countdown('B', 3, delay=2),
+        countdown('C', 4, delay=1),
+        echo('D', left, [b'ping', b'pong']),
+        reply(right),
+    )
+    start = time.monotonic()
+    loop.run_until_complete()
+    print('Elapsed: %.3f s' % (time.monotonic() - start))
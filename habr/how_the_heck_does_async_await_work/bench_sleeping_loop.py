@@ -0,0 +1,98 @@
+"""Масштабирование SleepingLoop: от 1k до 1M спящих сопрограмм
+
+Каждая сопрограмма SLEEPS раз спит случайное время до MAX_SLEEP: сроки вперемешку, много
+сопрограмм просыпаются в одну итерацию. Время сверх самого долгого сна - накладные
+расходы цикла, делим их на число пробуждений. Для сравнения - прежний цикл (Task на каждое
+пробуждение, datetime и timedelta), до LEGACY_MAX сопрограмм.
+
+usage: python bench_sleeping_loop.py [coroutines...]
+"""
+import heapq
+import importlib
+import random
+import sys
+import time
+
+from datetime import datetime, timedelta
+import types
+
+sleeping_loop = importlib.import_module('00_sleeping_loop')
+
+SLEEPS = 3
+MAX_SLEEP = 0.01
+# прежнему циклу на миллионе не хватит терпения
+LEGACY_MAX = 100_000
+
+
+class LegacyTask:
+    def __init__(self, waiting_until, coro):
+        self.coro = coro
+        self.waiting_until = waiting_until
+
+    def __eq__(self, other):
+        return self.waiting_until == other.waiting_until
+
+    def __lt__(self, other):
+        return self.waiting_until < other.waiting_until
+
+
+class LegacySleepingLoop:
+    """SleepingLoop до переделки"""
+    def __init__(self, *coros):
+        self._new = coros
+        self._waiting = []
+
+    def run_until_complete(self):
+        for coro in self._new:
+            wait_for = coro.send(None)
+            heapq.heappush(self._waiting, LegacyTask(wait_for, coro))
+
+        while self._waiting:
+            now = datetime.now()
+            task = heapq.heappop(self._waiting)
+            if now < task.waiting_until:
+                delta = task.waiting_until - now
+                time.sleep(delta.total_seconds())
+                now = datetime.now()
+            try:
+                wait_until = task.coro.send(now)
+                heapq.heappush(self._waiting, LegacyTask(wait_until, task.coro))
+            except StopIteration:
+                pass
+
+
+@types.coroutine
+def legacy_sleep(seconds):
+    now = datetime.now()
+    actual = yield now + timedelta(seconds=seconds)
+    return actual - now
+
+
+async def sleeper(sleep, delays):
+    for delay in delays:
+        await sleep(delay)
+
+
+def bench(name, loop_class, sleep, n):
+    delays = [[random.uniform(0, MAX_SLEEP) for _ in range(SLEEPS)] for _ in range(n)]
+    ideal = max(sum(coro_delays) for coro_delays in delays)
+    loop = loop_class(*(sleeper(sleep, coro_delays) for coro_delays in delays))
+    started = time.perf_counter()
+    loop.run_until_complete()
+    elapsed = time.perf_counter() - started
+    resumes = n * (SLEEPS + 1)
+    print(
+        f'{name:>6} {n:>9}: {elapsed:8.3f} s  overhead {max(elapsed - ideal, 0) / resumes * 1e6:6.2f} us'
+        f'  per resume'
+    )
+
+
+def main(sizes):
+    for n in sizes:
+        bench('new', sleeping_loop.SleepingLoop, sleeping_loop.sleep, n)
+        if n <= LEGACY_MAX:
+            bench('legacy', LegacySleepingLoop, legacy_sleep, n)
+
+
+if __name__ == '__main__':
+    main([int(n) for n in sys.argv[1:]] or [1_000, 10_000, 100_000, 1_000_000])